@@ -17,9 +17,12 @@ mkdir -p "$TMPROOT"/usr/local/managedmac/plugins/actions
 mkdir -p "$TMPROOT"/Library/LaunchDaemons
 
 cp -a source/managedmac "$TMPROOT"/usr/local/managedmac
+cp -a source/makerepoindex "$TMPROOT"/usr/local/managedmac
 cp -a source/mmlib/*.py "$TMPROOT"/usr/local/managedmac/mmlib
 cp -a source/plugins/actions/*.py "$TMPROOT"/usr/local/managedmac/plugins/actions
 cp -a launchd/LaunchDaemons/com.github.managedmac-auto.plist "$TMPROOT"/Library/LaunchDaemons
+cp -a launchd/LaunchDaemons/com.github.managedmac-retry.plist "$TMPROOT"/Library/LaunchDaemons
+cp -a launchd/LaunchDaemons/com.github.managedmac-daemon.plist "$TMPROOT"/Library/LaunchDaemons
 
 pkgbuild --root "$TMPROOT" --identifier "$IDENTIFIER" --version "$VERSION" --install-location / --scripts package_scripts managedmac.pkg
 if [ $? -eq 0 ]; then
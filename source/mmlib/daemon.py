@@ -0,0 +1,172 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Daniel Hazelbaker.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+daemon.py
+"""
+import os
+import sys
+import gc
+import time
+import random
+import signal
+import resource
+
+from mmlib import mmcommon
+
+
+#
+# Longest time to sleep in one go, so that a change of the system clock
+# is noticed within a reasonable time.
+#
+MAX_SLEEP = 60
+
+
+class Job(object):
+    """
+    Something the daemon runs on a schedule. After a successful run the
+    job is due again after interval seconds plus a random splay. After
+    a failure it is retried with an exponential backoff, starting at
+    backoff seconds and doubling up to max_backoff.
+    """
+
+    def __init__(self, name, interval, splay = 0, backoff = 60, max_backoff = 3600):
+        self.name = name
+        self.interval = interval
+        self.splay = splay
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.last_run = None
+        self.next_run = time.time() + random.uniform(0, splay)
+
+    def due(self, now):
+        return self.next_run <= now
+
+    def finished(self, ok, now = None):
+        """
+        Schedule the next run based on the result of this one.
+        """
+        if now is None:
+            now = time.time()
+        self.last_run = now
+
+        if ok:
+            self.failures = 0
+            delay = self.interval + random.uniform(0, self.splay)
+        else:
+            self.failures += 1
+            delay = min(self.backoff * (2 ** (self.failures - 1)), self.max_backoff)
+            mmcommon.log('Job ' + self.name + ' failed ' + str(self.failures) +
+                    ' time(s) in a row, next attempt in ' + str(int(delay)) + ' seconds')
+
+        self.next_run = now + delay
+
+
+class Daemon(object):
+    """
+    Stays resident and runs jobs when they are due. Each cycle calls
+    cycle(due_jobs) with the jobs that are due, which returns a
+    dictionary of job name to True or False for success. The daemon
+    exits when it receives SIGTERM or SIGINT, when one of the watched
+    files changes or when the process uses more than max_memory MB, so
+    that launchd can start a fresh copy.
+    """
+
+    def __init__(self, jobs, cycle, watch = None, max_memory = None):
+        self.jobs = jobs
+        self.cycle = cycle
+        self.max_memory = max_memory
+        self.stopping = False
+        self.watch = { }
+        for path in watch or [ ]:
+            self.watch[path] = fileStamp(path)
+
+    def run(self):
+        """
+        Run until stopped. Returns the reason for stopping.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopping:
+            now = time.time()
+            due = [ job for job in self.jobs if job.due(now) ]
+            if len(due) > 0:
+                try:
+                    results = self.cycle(due)
+                except Exception, e:
+                    mmcommon.log('Daemon cycle failed: ' + str(e))
+                    results = { }
+                now = time.time()
+                for job in due:
+                    job.finished(results.get(job.name, False), now)
+
+                #
+                # Nothing from the cycle needs to stay around except the
+                # caches, which are bounded on their own.
+                #
+                gc.collect()
+
+                reason = self.checkRestart()
+                if reason is not None:
+                    return reason
+
+            if not self.stopping:
+                wait = min([ job.next_run for job in self.jobs ]) - time.time()
+                if wait > 0:
+                    time.sleep(min(wait, MAX_SLEEP))
+
+        return 'signal'
+
+    def stop(self, signum = None, frame = None):
+        mmcommon.log('Daemon stopping')
+        self.stopping = True
+
+    def checkRestart(self):
+        """
+        Check if the process should exit so that it is started fresh.
+        Returns the reason or None.
+        """
+        for path in self.watch:
+            if fileStamp(path) != self.watch[path]:
+                mmcommon.log(path + ' has changed, restarting')
+                return 'updated'
+
+        memory = residentMemory()
+        if self.max_memory is not None and memory > self.max_memory * 1024 * 1024:
+            mmcommon.log('Using %d MB of memory, over the limit of %d MB, restarting' %
+                    (memory / (1024 * 1024), self.max_memory))
+            return 'memory'
+
+        return None
+
+
+def fileStamp(path):
+    try:
+        statinfo = os.stat(path)
+        return (statinfo.st_mtime, statinfo.st_size)
+    except OSError:
+        return None
+
+
+def residentMemory():
+    """
+    Get the peak resident memory of the process in bytes.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return usage
+    return usage * 1024
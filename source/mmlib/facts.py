@@ -0,0 +1,180 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Daniel Hazelbaker.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+facts.py
+"""
+import re
+import time
+import socket
+import threading
+import subprocess
+
+from mmlib import mmcommon
+from mmlib import metrics
+
+
+MANAGED_MAC_FACTS_PLIST = mmcommon.MANAGED_MAC_DIR + "/Facts.plist"
+
+STORE = mmcommon.PlistStore(MANAGED_MAC_FACTS_PLIST)
+LOCK = threading.RLock()
+
+#
+# Facts that are cheap to look up are never saved. NEVER keeps a fact
+# forever, even the serial number can change when the logic board is
+# replaced or an image is restored onto other hardware.
+#
+NEVER = None
+
+
+class Collector(object):
+    """
+    Looks up one or more facts with a single query. func is called with
+    a dictionary of the facts named in requires and returns a
+    dictionary of the facts it found. ttls gives the number of seconds
+    each fact stays valid, 0 to look it up every time or NEVER to keep
+    it forever.
+    """
+
+    def __init__(self, name, func, ttls, requires = None):
+        self.name = name
+        self.func = func
+        self.ttls = ttls
+        self.requires = list(requires or [ ])
+
+
+COLLECTORS = { }
+def registerCollector(name, func, ttls, requires = None):
+    """
+    Add a collector, replacing any existing collector with the same
+    name. Collectors can be replaced with fixtures on systems that do
+    not have the real tools.
+    """
+    with LOCK:
+        COLLECTORS[name] = Collector(name, func, ttls, requires)
+
+
+def collectorFor(fact):
+    for collector in COLLECTORS.values():
+        if fact in collector.ttls:
+            return collector
+
+    raise KeyError('No collector provides the fact ' + fact)
+
+
+def get(fact, default = None):
+    """
+    Get the value of a fact, using the saved value if it has not
+    expired. If it cannot be looked up then an expired value is used
+    if there is one, otherwise default is returned.
+    """
+    with LOCK:
+        collector = collectorFor(fact)
+        ttl = collector.ttls[fact]
+        saved = STORE.get(fact)
+        if saved is not None and (ttl is NEVER or time.time() - saved['Collected'] < ttl):
+            metrics.increment('FactHits')
+            return saved['Value']
+
+        metrics.increment('FactMisses')
+        values = collect(collector)
+        if fact in values:
+            return values[fact]
+        if saved is not None:
+            mmcommon.log('Could not look up ' + fact + ', using the value from ' + time.ctime(saved['Collected']))
+            return saved['Value']
+
+        return default
+
+
+def collect(collector):
+    """
+    Run a collector and save the facts it found.
+    """
+    requires = dict([ (name, get(name)) for name in collector.requires ])
+    try:
+        values = collector.func(requires) or { }
+    except Exception, e:
+        mmcommon.log('Collecting ' + collector.name + ' facts failed: ' + str(e))
+        values = { }
+
+    now = int(time.time())
+    for fact in values:
+        if values[fact] is not None and collector.ttls.get(fact) != 0:
+            STORE.set(fact, { 'Value': values[fact], 'Collected': now })
+
+    return dict([ (fact, values[fact]) for fact in values if values[fact] is not None ])
+
+
+def reset():
+    """
+    Forget every saved fact so they are all looked up again.
+    """
+    with LOCK:
+        with STORE.lock:
+            STORE.load().clear()
+            STORE.markDirty()
+
+
+def collectPlatform(requires):
+    """
+    Get the serial number and hardware UUID from the platform expert.
+    """
+    output = subprocess.check_output(['/usr/sbin/ioreg', '-rd1', '-c', 'IOPlatformExpertDevice'])
+
+    values = { }
+    for (key, fact) in [ ('IOPlatformSerialNumber', 'SerialNumber'), ('IOPlatformUUID', 'UUID') ]:
+        match = re.search('\"' + key + '\" = \"(.*)\"', output)
+        if match is not None:
+            values[fact] = match.group(1)
+
+    return values
+
+
+def collectHostname(requires):
+    return { 'Hostname': socket.gethostname() }
+
+
+def collectNetwork(requires):
+    """
+    Get the ethernet address of the primary interface.
+    """
+    output = subprocess.check_output(['/sbin/ifconfig', 'en0'], stderr = subprocess.STDOUT)
+    match = re.search('^\s*ether\s+(\S+)', output, re.MULTILINE)
+
+    return { 'MACAddress': match.group(1) if match is not None else None }
+
+
+def collectDirectory(requires):
+    """
+    Find the name of the computer record in Open Directory that has
+    the ethernet address of this system.
+    """
+    if requires.get('MACAddress') is None:
+        return { }
+
+    output = subprocess.check_output(['/usr/bin/dscl', 'localhost', '-search', mmcommon.pref('ODNode'), 'ENetAddress', requires['MACAddress']], stderr = subprocess.STDOUT)
+    for line in output.split('\n'):
+        if line.startswith('Computers'):
+            name = line.split()[0].split('/')[1]
+            return { 'ODName': re.sub('[^-a-z0-9A-Z]', '', name) }
+
+    return { }
+
+
+registerCollector('platform', collectPlatform, { 'SerialNumber': 24 * 3600, 'UUID': 24 * 3600 })
+registerCollector('hostname', collectHostname, { 'Hostname': 0 })
+registerCollector('network', collectNetwork, { 'MACAddress': 24 * 3600 })
+registerCollector('directory', collectDirectory, { 'ODName': 24 * 3600 }, [ 'MACAddress' ])
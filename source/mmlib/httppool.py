@@ -0,0 +1,262 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Daniel Hazelbaker.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+httppool.py
+"""
+import httplib
+import socket
+import threading
+import time
+import base64
+import urllib
+import urlparse
+
+
+REDIRECT_CODES = [ 301, 302, 303, 307, 308 ]
+MAX_REDIRECTS = 5
+
+
+class ConnectionPool(object):
+    """
+    Pool of keep-alive HTTP/HTTPS connections keyed by host. Connections
+    are handed back to the pool once a response has been fully read so
+    that later requests to the same host skip the TCP and TLS handshake.
+    The proxies in the environment or the system settings are used the
+    same way urllib2 would use them, unless proxies is given.
+    """
+
+    def __init__(self, max_per_host = 4, timeout = 60, proxies = None):
+        self.max_per_host = max(1, int(max_per_host))
+        self.timeout = timeout
+        self.proxies = urllib.getproxies() if proxies is None else proxies
+        self.lock = threading.Condition()
+        self.idle = { }
+        self.active = { }
+        self.stats = {
+            'Requests': 0,
+            'ConnectionsOpened': 0,
+            'ConnectionsReused': 0,
+            'HandshakeTime': 0.0,
+        }
+
+    def request(self, url, headers = None):
+        """
+        Perform a GET request for url, following redirects. Returns a
+        PooledResponse which must be read and then closed.
+        """
+        for redirect in range(MAX_REDIRECTS + 1):
+            response = self._request(url, headers or { })
+            if response.getcode() not in REDIRECT_CODES:
+                return response
+
+            location = response.info().getheader('Location')
+            response.read()
+            response.close()
+            if location is None:
+                raise IOError('Redirect received without a location')
+            url = urlparse.urljoin(url, location)
+
+        raise IOError('Too many redirects')
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self.lock:
+            for key in self.idle:
+                for conn in self.idle[key]:
+                    conn.close()
+            self.idle = { }
+
+    def summary(self):
+        """
+        Return a single line description of the pool counters.
+        """
+        with self.lock:
+            return ('%d requests, %d connections opened, %d reused, %.3f seconds in handshakes' %
+                    (self.stats['Requests'], self.stats['ConnectionsOpened'],
+                     self.stats['ConnectionsReused'], self.stats['HandshakeTime']))
+
+    def _request(self, url, headers):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise IOError('Unsupported URL scheme: ' + parts.scheme)
+
+        proxy = self._proxy(parts.scheme, parts.hostname)
+        key = (parts.scheme, parts.hostname, parts.port, proxy)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        headers = dict(headers)
+        if parts.username is not None:
+            credentials = parts.username + ':' + (parts.password or '')
+            headers['Authorization'] = 'Basic ' + base64.b64encode(credentials)
+
+        #
+        # Plain HTTP requests are forwarded by the proxy so they name the
+        # whole URL, HTTPS requests go through a tunnel instead.
+        #
+        if proxy is not None and parts.scheme == 'http':
+            path = urlparse.urlunsplit((parts.scheme, parts.netloc.rpartition('@')[2], path, '', ''))
+            if proxy[2] is not None:
+                headers['Proxy-Authorization'] = proxy[2]
+
+        #
+        # A reused connection may have been closed by the server while it
+        # sat idle, in that case try once more on a fresh connection.
+        #
+        (conn, reused) = self._acquire(key)
+        try:
+            try:
+                conn.request('GET', path, headers = headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                conn = self._connect(key)
+                reused = False
+                conn.request('GET', path, headers = headers)
+                response = conn.getresponse()
+        except:
+            self._release(key, conn, False)
+            raise
+
+        with self.lock:
+            self.stats['Requests'] += 1
+
+        return PooledResponse(self, key, conn, response, url)
+
+    def _acquire(self, key):
+        """
+        Get an idle connection for the host or open a new one, waiting
+        if the host already has max_per_host connections in use.
+        """
+        with self.lock:
+            while True:
+                if len(self.idle.get(key, [ ])) > 0:
+                    self.active[key] = self.active.get(key, 0) + 1
+                    self.stats['ConnectionsReused'] += 1
+                    return (self.idle[key].pop(), True)
+                if self.active.get(key, 0) < self.max_per_host:
+                    self.active[key] = self.active.get(key, 0) + 1
+                    break
+                self.lock.wait()
+
+        try:
+            return (self._connect(key), False)
+        except:
+            self._release(key, None, False)
+            raise
+
+    def _proxy(self, scheme, host):
+        """
+        Get the (host, port, Proxy-Authorization) of the proxy to use for
+        a request or None to connect directly.
+        """
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.proxy_bypass(host):
+            return None
+
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urlparse.urlsplit(proxy)
+        if parts.scheme != 'http':
+            raise IOError('Unsupported proxy scheme: ' + parts.scheme)
+
+        authorization = None
+        if parts.username is not None:
+            credentials = urllib.unquote(parts.username) + ':' + urllib.unquote(parts.password or '')
+            authorization = 'Basic ' + base64.b64encode(credentials)
+
+        return (parts.hostname, parts.port, authorization)
+
+    def _connect(self, key):
+        (scheme, host, port, proxy) = key
+        if proxy is not None and scheme == 'https':
+            conn = httplib.HTTPSConnection(proxy[0], proxy[1], timeout = self.timeout)
+            tunnel_headers = { }
+            if proxy[2] is not None:
+                tunnel_headers['Proxy-Authorization'] = proxy[2]
+            conn.set_tunnel(host, port, tunnel_headers)
+        elif proxy is not None:
+            conn = httplib.HTTPConnection(proxy[0], proxy[1], timeout = self.timeout)
+        elif scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout = self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout = self.timeout)
+
+        start = time.time()
+        conn.connect()
+        elapsed = time.time() - start
+
+        with self.lock:
+            self.stats['ConnectionsOpened'] += 1
+            self.stats['HandshakeTime'] += elapsed
+
+        return conn
+
+    def _release(self, key, conn, reusable):
+        with self.lock:
+            self.active[key] = self.active.get(key, 1) - 1
+            if conn is not None:
+                if reusable:
+                    self.idle.setdefault(key, [ ]).append(conn)
+                else:
+                    conn.close()
+            self.lock.notify()
+
+
+class PooledResponse(object):
+    """
+    Wrapper around an httplib response that returns the connection to
+    the pool when closed. Provides the getcode()/info()/geturl() calls
+    of a urllib2 response.
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+
+    def getcode(self):
+        return self.response.status
+
+    def info(self):
+        return self.response.msg
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt = None):
+        return self.response.read(amt)
+
+    def close(self):
+        if self.conn is None:
+            return
+
+        #
+        # The connection can only be reused if the whole body was read
+        # and the server did not ask to close it.
+        #
+        reusable = self.response.isclosed() and not self.response.will_close
+        if not reusable:
+            self.response.close()
+        self.pool._release(self.key, self.conn, reusable)
+        self.conn = None
@@ -0,0 +1,595 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Daniel Hazelbaker.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+ipp.py
+"""
+import re
+import struct
+import socket
+import httplib
+import threading
+import urllib
+
+
+#
+# Operations.
+#
+PAUSE_PRINTER = 0x0010
+RESUME_PRINTER = 0x0011
+GET_JOBS = 0x000A
+GET_PRINTER_ATTRIBUTES = 0x000B
+CUPS_GET_PRINTERS = 0x4002
+CUPS_ADD_MODIFY_PRINTER = 0x4003
+CUPS_DELETE_PRINTER = 0x4004
+CUPS_ACCEPT_JOBS = 0x4008
+CUPS_REJECT_JOBS = 0x4009
+
+#
+# Operations that only read state and can safely be sent twice.
+#
+READ_ONLY_OPERATIONS = [ GET_PRINTER_ATTRIBUTES, GET_JOBS, CUPS_GET_PRINTERS ]
+
+#
+# Delimiter tags.
+#
+OPERATION_ATTRIBUTES_TAG = 0x01
+JOB_ATTRIBUTES_TAG = 0x02
+END_OF_ATTRIBUTES_TAG = 0x03
+PRINTER_ATTRIBUTES_TAG = 0x04
+
+#
+# Value tags.
+#
+INTEGER = 0x21
+BOOLEAN = 0x22
+ENUM = 0x23
+OCTET_STRING = 0x30
+BEGIN_COLLECTION = 0x34
+TEXT_WITH_LANGUAGE = 0x35
+NAME_WITH_LANGUAGE = 0x36
+END_COLLECTION = 0x37
+TEXT = 0x41
+NAME = 0x42
+KEYWORD = 0x44
+URI = 0x45
+CHARSET = 0x47
+NATURAL_LANGUAGE = 0x48
+MIME_MEDIA_TYPE = 0x49
+MEMBER_ATTR_NAME = 0x4A
+
+#
+# Status codes.
+#
+CLIENT_ERROR_NOT_FOUND = 0x0406
+
+#
+# Printer states.
+#
+PRINTER_STATE_IDLE = 3
+PRINTER_STATE_PROCESSING = 4
+PRINTER_STATE_STOPPED = 5
+
+LOCAL_CERTIFICATES = [ '/private/var/run/cups/certs/0', '/var/run/cups/certs/0' ]
+
+
+class IPPError(Exception):
+    """
+    Raised when an IPP request could not be completed. status is the
+    IPP status code if cupsd answered the request. delivered is True
+    if the request was sent in full but no answer came back, in which
+    case cupsd may have acted on it.
+    """
+
+    def __init__(self, message, status = None, delivered = False):
+        Exception.__init__(self, message)
+        self.status = status
+        self.delivered = delivered
+
+
+class IPPConnectionError(IPPError):
+    """
+    Raised when cupsd could not be talked to at all.
+    """
+
+
+def encodeRequest(operation, request_id, groups, data = ''):
+    """
+    Encode an IPP request. groups is a list of (group tag, attributes)
+    tuples, where attributes is a list of (name, value tag, value)
+    tuples. A value may be a list to send a multi-valued attribute.
+    """
+    message = struct.pack('>BBHI', 2, 0, operation, request_id)
+
+    for (group_tag, attributes) in groups:
+        message += struct.pack('>B', group_tag)
+        for (name, value_tag, values) in attributes:
+            if not isinstance(values, list):
+                values = [ values ]
+            for index in range(len(values)):
+                value = encodeValue(value_tag, values[index])
+                attr_name = name if index == 0 else ''
+                message += struct.pack('>BH', value_tag, len(attr_name)) + attr_name
+                message += struct.pack('>H', len(value)) + value
+
+    message += struct.pack('>B', END_OF_ATTRIBUTES_TAG)
+
+    return message + data
+
+
+def encodeValue(value_tag, value):
+    if value_tag in (INTEGER, ENUM):
+        return struct.pack('>i', value)
+    elif value_tag == BOOLEAN:
+        return struct.pack('>B', 1 if value else 0)
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    else:
+        return str(value)
+
+
+def decodeResponse(message):
+    """
+    Decode an IPP response. Returns a tuple of the status code and a list
+    of (group tag, attributes) tuples, where attributes is a dictionary
+    of attribute name to a list of values.
+    """
+    if len(message) < 8:
+        raise IPPError('Short IPP response')
+
+    (major, minor, status, request_id) = struct.unpack('>BBHI', message[:8])
+    groups = [ ]
+    attributes = None
+    name = None
+    offset = 8
+
+    while offset < len(message):
+        tag = ord(message[offset])
+        offset += 1
+
+        if tag == END_OF_ATTRIBUTES_TAG:
+            break
+        if tag < 0x10:
+            attributes = { }
+            groups.append((tag, attributes))
+            continue
+
+        (attr_name, value, offset) = decodeAttribute(message, tag, offset)
+        if attributes is None:
+            raise IPPError('Attribute outside of a group in IPP response')
+        if attr_name != '':
+            name = attr_name
+            attributes[name] = [ ]
+        if name is not None:
+            attributes[name].append(value)
+
+    return (status, groups)
+
+
+def decodeAttribute(message, tag, offset):
+    """
+    Decode a single attribute starting after its value tag. Returns the
+    attribute name, decoded value and the offset of the next tag.
+    """
+    (name_length,) = struct.unpack('>H', message[offset:offset + 2])
+    offset += 2
+    name = message[offset:offset + name_length]
+    offset += name_length
+    (value_length,) = struct.unpack('>H', message[offset:offset + 2])
+    offset += 2
+    raw = message[offset:offset + value_length]
+    offset += value_length
+
+    if tag == BEGIN_COLLECTION:
+        (value, offset) = decodeCollection(message, offset)
+        return (name, value, offset)
+
+    return (name, decodeValue(tag, raw), offset)
+
+
+def decodeCollection(message, offset):
+    """
+    Decode the members of a collection value up to its end tag.
+    """
+    collection = { }
+    member = None
+
+    while offset < len(message):
+        tag = ord(message[offset])
+        offset += 1
+        (unused_name, value, offset) = decodeAttribute(message, tag, offset)
+
+        if tag == END_COLLECTION:
+            break
+        elif tag == MEMBER_ATTR_NAME:
+            member = value
+            collection[member] = [ ]
+        elif member is not None:
+            collection[member].append(value)
+
+    return (collection, offset)
+
+
+def decodeValue(tag, raw):
+    if tag in (INTEGER, ENUM):
+        return struct.unpack('>i', raw)[0]
+    elif tag == BOOLEAN:
+        return ord(raw) != 0
+    elif tag in (TEXT_WITH_LANGUAGE, NAME_WITH_LANGUAGE):
+        (lang_length,) = struct.unpack('>H', raw[:2])
+        (text_length,) = struct.unpack('>H', raw[2 + lang_length:4 + lang_length])
+        return raw[4 + lang_length:4 + lang_length + text_length]
+    elif tag < 0x20:
+        return None
+    else:
+        return raw
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """
+    HTTP connection to a server listening on a unix domain socket.
+    """
+
+    def __init__(self, path, timeout = 30):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout = timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class IPPConnection(object):
+    """
+    A single keep-alive connection to cupsd used to send IPP requests.
+    Requests are serialized so the connection can be shared by threads.
+    """
+
+    def __init__(self, host = 'localhost', port = 631, socket_path = None, timeout = 30):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.conn = None
+        self.request_id = 0
+        self.lock = threading.Lock()
+
+    def request(self, operation, attributes, printer_attributes = None, data = '', resource = '/'):
+        """
+        Send an IPP request and return the decoded response groups. The
+        charset, language and requesting user attributes are added
+        automatically. Raises IPPError if the request failed.
+        """
+        operation_attributes = [
+            ('attributes-charset', CHARSET, 'utf-8'),
+            ('attributes-natural-language', NATURAL_LANGUAGE, 'en'),
+        ] + attributes + [
+            ('requesting-user-name', NAME, 'root'),
+        ]
+        groups = [ (OPERATION_ATTRIBUTES_TAG, operation_attributes) ]
+        if printer_attributes:
+            groups.append((PRINTER_ATTRIBUTES_TAG, printer_attributes))
+
+        with self.lock:
+            self.request_id += 1
+            body = encodeRequest(operation, self.request_id, groups, data)
+            headers = { 'Content-Type': 'application/ipp' }
+            (code, response) = self._send('POST', resource, body, headers, operation in READ_ONLY_OPERATIONS)
+
+        if code != 200:
+            raise IPPError('HTTP error ' + str(code) + ' from cupsd')
+
+        try:
+            (status, groups) = decodeResponse(response)
+        except IPPError, e:
+            raise IPPError(str(e), None, True)
+        if status >= 0x0100:
+            raise IPPError('IPP request failed with status 0x%04x' % status, status)
+
+        return groups
+
+    def get(self, resource):
+        """
+        Fetch a plain HTTP resource from cupsd, such as a printer's PPD.
+        """
+        with self.lock:
+            (code, response) = self._send('GET', resource, None, { }, True)
+
+        if code != 200:
+            raise IPPError('HTTP error ' + str(code) + ' fetching ' + resource)
+
+        return response
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def _send(self, method, resource, body, headers, read_only):
+        certificate = localCertificate()
+        if certificate is not None:
+            headers['Authorization'] = 'Local ' + certificate
+
+        #
+        # Retry once on a fresh connection if the server closed the
+        # connection we were holding on to. A change that may already
+        # have reached cupsd is never sent a second time.
+        #
+        for attempt in range(2):
+            if self.conn is None:
+                if self.socket_path is not None:
+                    self.conn = UnixHTTPConnection(self.socket_path, self.timeout)
+                else:
+                    self.conn = httplib.HTTPConnection(self.host, self.port, timeout = self.timeout)
+            delivered = False
+            try:
+                self.conn.request(method, resource, body, headers)
+                delivered = True
+                response = self.conn.getresponse()
+                data = response.read()
+                if response.will_close:
+                    self.conn.close()
+                    self.conn = None
+                return (response.status, data)
+            except (httplib.HTTPException, socket.error), e:
+                self.conn.close()
+                self.conn = None
+                if attempt == 1 or (delivered and not read_only):
+                    raise IPPConnectionError('Could not talk to cupsd: ' + str(e), None, delivered)
+
+
+def localCertificate():
+    """
+    Read the CUPS local certificate used to authenticate root to cupsd.
+    """
+    for path in LOCAL_CERTIFICATES:
+        try:
+            with open(path, 'r') as fp:
+                return fp.read().strip()
+        except IOError:
+            pass
+
+    return None
+
+
+class IPPBackend(object):
+    """
+    Printer backend that talks IPP directly to cupsd.
+    """
+
+    def __init__(self, connection = None):
+        self.connection = connection or IPPConnection()
+
+    def printerUri(self, printer_name):
+        return 'ipp://localhost/printers/' + urllib.quote(printer_name)
+
+    def snapshot(self):
+        """
+        Return the state of every printer in the same form as
+        printers.parseLpstat().
+        """
+        try:
+            groups = self.connection.request(CUPS_GET_PRINTERS, [
+                ('requested-attributes', KEYWORD, [ 'printer-name', 'device-uri',
+                        'printer-is-accepting-jobs', 'printer-state', 'queued-job-count' ]),
+            ])
+        except IPPError, e:
+            if e.status == CLIENT_ERROR_NOT_FOUND:
+                return { }
+            raise
+
+        result = { }
+        for (tag, attributes) in groups:
+            if tag == PRINTER_ATTRIBUTES_TAG and 'printer-name' in attributes:
+                result[attributes['printer-name'][0]] = printerEntry(attributes)
+
+        return result
+
+    def exists(self, printer_name):
+        return self._attributes(printer_name) is not None
+
+    def uri(self, printer_name):
+        attributes = self._attributes(printer_name)
+        if attributes is None:
+            return 0
+        return printerEntry(attributes)['uri']
+
+    def status(self, printer_name):
+        attributes = self._attributes(printer_name)
+        if attributes is None:
+            return 0
+        return printerEntry(attributes)['status']
+
+    def jobCount(self, printer_name):
+        try:
+            groups = self.connection.request(GET_JOBS, [
+                ('printer-uri', URI, self.printerUri(printer_name)),
+                ('which-jobs', KEYWORD, 'not-completed'),
+                ('requested-attributes', KEYWORD, 'job-id'),
+            ])
+        except IPPError, e:
+            if e.status == CLIENT_ERROR_NOT_FOUND:
+                return -1
+            raise
+
+        return len([ g for g in groups if g[0] == JOB_ATTRIBUTES_TAG ])
+
+    def add(self, printer_name, uri, ppd, location, description):
+        printer_attributes = [
+            ('device-uri', URI, uri),
+            ('printer-location', TEXT, location),
+            ('printer-info', TEXT, description),
+            ('printer-is-accepting-jobs', BOOLEAN, True),
+            ('printer-state', ENUM, PRINTER_STATE_IDLE),
+        ]
+        data = ''
+        if ppd[:4] == 'drv:':
+            printer_attributes.append(('ppd-name', NAME, ppd))
+        else:
+            with open(ppd, 'rb') as fp:
+                data = fp.read()
+
+        self.connection.request(CUPS_ADD_MODIFY_PRINTER, [
+            ('printer-uri', URI, self.printerUri(printer_name)),
+        ], printer_attributes, data, '/admin/')
+
+        return True
+
+    def delete(self, printer_name):
+        self.connection.request(CUPS_DELETE_PRINTER, [
+            ('printer-uri', URI, self.printerUri(printer_name)),
+        ], None, '', '/admin/')
+
+        return True
+
+    def setOptions(self, printer_name, options):
+        """
+        Set default options the same way lpadmin -o does. Options found
+        in the printer's PPD are changed in the PPD, which is then sent
+        back to cupsd. The printer attributes in PRINTER_OPTIONS are
+        set with their proper types. Any other option raises IPPError
+        before anything is changed, so that the call is made with
+        lpadmin instead.
+        """
+        ppd = self.connection.get('/printers/' + urllib.quote(printer_name) + '.ppd')
+        (ppd, remaining) = setPPDDefaults(ppd, options)
+
+        unknown = [ key for key in remaining if key not in PRINTER_OPTIONS ]
+        if len(unknown) > 0:
+            raise IPPError('Options not supported by the IPP backend: ' + ', '.join(sorted(unknown)))
+
+        printer_attributes = [ ]
+        for key in sorted(remaining):
+            printer_attributes.append(printerOption(key, remaining[key]))
+
+        self.connection.request(CUPS_ADD_MODIFY_PRINTER, [
+            ('printer-uri', URI, self.printerUri(printer_name)),
+        ], printer_attributes, ppd, '/admin/')
+
+        return True
+
+    def acceptJobs(self, printer_name):
+        return self._printerOperation(CUPS_ACCEPT_JOBS, printer_name)
+
+    def rejectJobs(self, printer_name):
+        return self._printerOperation(CUPS_REJECT_JOBS, printer_name)
+
+    def pause(self, printer_name):
+        return self._printerOperation(PAUSE_PRINTER, printer_name)
+
+    def resume(self, printer_name):
+        return self._printerOperation(RESUME_PRINTER, printer_name)
+
+    def _printerOperation(self, operation, printer_name):
+        self.connection.request(operation, [
+            ('printer-uri', URI, self.printerUri(printer_name)),
+        ], None, '', '/admin/')
+
+        return True
+
+    def _attributes(self, printer_name):
+        try:
+            groups = self.connection.request(GET_PRINTER_ATTRIBUTES, [
+                ('printer-uri', URI, self.printerUri(printer_name)),
+                ('requested-attributes', KEYWORD, [ 'printer-name', 'device-uri',
+                        'printer-is-accepting-jobs', 'printer-state', 'queued-job-count' ]),
+            ])
+        except IPPError, e:
+            if e.status == CLIENT_ERROR_NOT_FOUND:
+                return None
+            raise
+
+        for (tag, attributes) in groups:
+            if tag == PRINTER_ATTRIBUTES_TAG:
+                return attributes
+
+        return None
+
+
+#
+# Options that lpadmin -o sets as printer attributes rather than in the
+# PPD, with their value tag and whether they take a list of values.
+#
+PRINTER_OPTIONS = {
+    'printer-is-shared': (BOOLEAN, False),
+    'printer-error-policy': (NAME, False),
+    'printer-op-policy': (NAME, False),
+    'port-monitor': (NAME, False),
+    'job-sheets-default': (NAME, True),
+    'requesting-user-name-allowed': (NAME, True),
+    'requesting-user-name-denied': (NAME, True),
+    'job-quota-period': (INTEGER, False),
+    'job-k-limit': (INTEGER, False),
+    'job-page-limit': (INTEGER, False),
+}
+
+
+def printerOption(key, value):
+    """
+    Convert an lpadmin -o option into a (name, value tag, value)
+    printer attribute, see PRINTER_OPTIONS.
+    """
+    (tag, multiple) = PRINTER_OPTIONS[key]
+    values = [ v.strip() for v in str(value).split(',') ] if multiple else [ value ]
+    if tag == BOOLEAN:
+        values = [ v if isinstance(v, bool) else str(v).lower() in ('true', 'yes', 'on', '1') for v in values ]
+    elif tag == INTEGER:
+        values = [ int(v) for v in values ]
+
+    return (key, tag, values if multiple else values[0])
+
+
+def printerEntry(attributes):
+    """
+    Convert the IPP attributes of a printer into the uri, accepting,
+    status and jobs entry used by printers.CupsSnapshot.
+    """
+    state = attributes.get('printer-state', [ None ])[0]
+    if state == PRINTER_STATE_IDLE:
+        status = 'idle'
+    elif state == PRINTER_STATE_PROCESSING:
+        status = 'printing'
+    elif state == PRINTER_STATE_STOPPED:
+        status = 'paused'
+    else:
+        status = 'unknown'
+
+    return {
+        'uri': attributes.get('device-uri', [ '' ])[0],
+        'accepting': attributes.get('printer-is-accepting-jobs', [ False ])[0] == True,
+        'status': status,
+        'jobs': attributes.get('queued-job-count', [ 0 ])[0],
+    }
+
+
+def setPPDDefaults(ppd, options):
+    """
+    Change the *Default lines of the PPD text for the given options.
+    Returns the new PPD text and a dictionary of the options that were
+    not found in the PPD.
+    """
+    remaining = dict(options)
+    lines = ppd.split('\n')
+
+    for index in range(len(lines)):
+        match = re.match('\*Default([^:/ \t]+)([^:]*):', lines[index])
+        if match and match.group(1) in remaining:
+            ending = '\r' if lines[index].endswith('\r') else ''
+            lines[index] = '*Default' + match.group(1) + match.group(2) + ': ' + remaining[match.group(1)] + ending
+            del remaining[match.group(1)]
+
+    return ('\n'.join(lines), remaining)
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Daniel Hazelbaker.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+loader.py
+"""
+import os
+import sys
+import imp
+import struct
+import marshal
+import hashlib
+import tempfile
+
+from mmlib import mmcommon
+
+
+PLUGIN_CACHE_DIR = mmcommon.MANAGED_MAC_DIR + "/PluginCache"
+
+#
+# Cache files start with the bytecode magic number of the running
+# interpreter followed by the modification time and size of the source.
+#
+CACHE_HEADER = struct.Struct('<4sqq')
+
+
+def loadPlugin(path, entry_points = ('run', 'retry')):
+    """
+    Load the plugin at path and return it as a module. The compiled
+    code is cached by the modification time and size of the source so
+    that plugins are only compiled when they change. Files that do not
+    define any of the entry_points are not plugins and None is returned.
+    """
+    code = compiledCode(path)
+
+    name = 'mmplugin_' + hashlib.md5(path).hexdigest()
+    module = imp.new_module(name)
+    module.__file__ = path
+    sys.modules[name] = module
+    try:
+        exec code in module.__dict__
+    except:
+        del sys.modules[name]
+        raise
+
+    for entry_point in entry_points:
+        if hasattr(module, entry_point):
+            return module
+
+    del sys.modules[name]
+    return None
+
+
+def compiledCode(path):
+    """
+    Get the compiled code of the Python file at path, using the cached
+    copy if the file has not changed since it was compiled.
+    """
+    statinfo = os.stat(path)
+    cache_path = PLUGIN_CACHE_DIR + '/' + hashlib.md5(path).hexdigest() + '.pyc'
+    header = CACHE_HEADER.pack(imp.get_magic(), int(statinfo.st_mtime), statinfo.st_size)
+
+    try:
+        with open(cache_path, 'rb') as fp:
+            if fp.read(CACHE_HEADER.size) == header:
+                return marshal.loads(fp.read())
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+
+    with open(path, 'rU') as fp:
+        source = fp.read()
+    code = compile(source + '\n', path, 'exec')
+
+    #
+    # Failing to write the cache only costs a compile on the next run.
+    #
+    try:
+        if not os.path.exists(PLUGIN_CACHE_DIR):
+            os.mkdir(PLUGIN_CACHE_DIR)
+        (fd, temp_path) = tempfile.mkstemp(dir = PLUGIN_CACHE_DIR)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(header)
+            marshal.dump(code, fp)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError):
+        pass
+
+    return code
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Daniel Hazelbaker.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+metrics.py
+"""
+import os
+import time
+import json
+import datetime
+import threading
+import subprocess
+
+
+MAX_DOWNLOADS = 1000
+
+#
+# Counters that make up each reported cache hit rate.
+#
+CACHE_COUNTERS = {
+    'Validators': ('ValidatorHits', 'ValidatorMisses'),
+    'ParsedPlists': ('ParsedPlistHits', 'ParsedPlistMisses'),
+    'PPDCache': ('PPDCacheHits', 'PPDCacheMisses'),
+    'PPDInfo': ('PPDInfoHits', 'PPDInfoMisses'),
+    'PrinterFingerprints': ('PrinterFingerprintHits', 'PrinterFingerprintMisses'),
+    'Facts': ('FactHits', 'FactMisses'),
+    'RepoIndex': ('RepoIndexHits', 'RepoIndexMisses'),
+}
+
+LOCK = threading.RLock()
+RUN = None
+POPEN = subprocess.Popen
+
+
+def reset():
+    """
+    Start a new metrics record for this run.
+    """
+    global RUN
+
+    with LOCK:
+        RUN = {
+            'Start': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'StartTime': time.time(),
+            'Counters': { },
+            'Actions': { },
+            'Downloads': [ ],
+        }
+
+
+def increment(name, amount = 1):
+    """
+    Add amount to the named counter.
+    """
+    with LOCK:
+        RUN['Counters'][name] = RUN['Counters'].get(name, 0) + amount
+
+
+def setValue(name, value):
+    """
+    Set a top level value of the run record.
+    """
+    with LOCK:
+        RUN[name] = value
+
+
+def recordAction(name, seconds, result):
+    """
+    Record the wall time and result of an action plugin.
+    """
+    with LOCK:
+        RUN['Actions'][name] = { 'Seconds': round(seconds, 3), 'Result': result }
+
+
+def recordDownload(url, seconds, size, status):
+    """
+    Record the latency and size of a single download.
+    """
+    with LOCK:
+        if len(RUN['Downloads']) < MAX_DOWNLOADS:
+            RUN['Downloads'].append({
+                'URL': url,
+                'Seconds': round(seconds, 3),
+                'Bytes': size,
+                'Status': status,
+            })
+
+
+def write(path, history = 500):
+    """
+    Append the run record as a JSON line to path, keeping at most
+    history records in the file.
+    """
+    with LOCK:
+        record = dict(RUN)
+        record['WallTime'] = round(time.time() - record.pop('StartTime'), 3)
+        record['CacheHitRates'] = { }
+        for name in CACHE_COUNTERS:
+            (hits, misses) = [ record['Counters'].get(c, 0) for c in CACHE_COUNTERS[name] ]
+            if hits + misses > 0:
+                record['CacheHitRates'][name] = round(float(hits) / (hits + misses), 3)
+        line = json.dumps(record, sort_keys = True)
+
+    try:
+        with open(path, 'r') as fp:
+            lines = fp.readlines()
+    except IOError:
+        lines = [ ]
+
+    lines = lines[-(history - 1):] if history > 1 else [ ]
+    lines.append(line + '\n')
+
+    with open(path + '.tmp', 'w') as fp:
+        fp.writelines(lines)
+    os.rename(path + '.tmp', path)
+
+
+class CountingPopen(POPEN):
+    """
+    subprocess.Popen that counts each spawned process and the time until
+    it was reaped. Installed by installSubprocessHook() so that every
+    subprocess.call/check_output in the tree is counted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.metrics_start = time.time()
+        self.metrics_done = False
+        increment('SubprocessSpawns')
+        POPEN.__init__(self, *args, **kwargs)
+
+    def wait(self):
+        result = POPEN.wait(self)
+        self.metricsDone()
+        return result
+
+    def communicate(self, input = None):
+        result = POPEN.communicate(self, input)
+        self.metricsDone()
+        return result
+
+    def metricsDone(self):
+        if not self.metrics_done and self.returncode is not None:
+            self.metrics_done = True
+            increment('SubprocessSeconds', round(time.time() - self.metrics_start, 3))
+
+
+def installSubprocessHook():
+    """
+    Replace subprocess.Popen with CountingPopen.
+    """
+    if subprocess.Popen is not CountingPopen:
+        subprocess.Popen = CountingPopen
+
+
+reset()
@@ -16,29 +16,43 @@
 """
 common.py
 """
-import urllib
 import os
 import sys
 import subprocess
 import tempfile
-import re
-import platform
 import datetime
-from Foundation import NSDictionary
-from Foundation import CFPreferencesCopyAppValue
+import time
+import threading
+import Queue
+import hashlib
+import atexit
+from mmlib import metrics
+from mmlib import plist
+
+#
+# urllib2, httplib and gzip are slow to import and not needed
+# by every run, so they are imported when first used.
+#
 
 
 BUNDLE_ID = "ManagedMac"
 MANAGED_MAC_DIR = "/Library/" + BUNDLE_ID
 MANAGED_MAC_LOGDIR = MANAGED_MAC_DIR + "/Logs"
 MANAGED_MAC_LOGFILE = MANAGED_MAC_LOGDIR + "/ManagedMac.log"
+MANAGED_MAC_METRICSFILE = MANAGED_MAC_LOGDIR + "/ManagedMacMetrics.jsonl"
 MANAGED_MAC_CATALOGDIR = MANAGED_MAC_DIR + "/catalogs"
 MANAGED_MAC_MANIFESTDIR = MANAGED_MAC_DIR + "/manifests"
+MANAGED_MAC_PPDCACHEDIR = MANAGED_MAC_DIR + "/PPDCache"
 MANAGED_MAC_CATALOG_PLIST = MANAGED_MAC_CATALOGDIR + "/client_catalog.plist"
 MANAGED_MAC_MANIFEST_PLIST = MANAGED_MAC_MANIFESTDIR + "/client_manifest.plist"
+MANAGED_MAC_VALIDATORS_PLIST = MANAGED_MAC_DIR + "/Validators.plist"
+MANAGED_MAC_REPO_INDEX_PLIST = MANAGED_MAC_DIR + "/RepoIndex.plist"
+MANAGED_MAC_PREFERENCES_PLIST = "/Library/Preferences/" + BUNDLE_ID + ".plist"
 
 log_console = False
 log_module_name = 'Core'
+offline = False
+serial = False
 
 
 def prepare(needRoot = True):
@@ -57,6 +71,7 @@ def prepare(needRoot = True):
         createPath(MANAGED_MAC_LOGDIR)
         createPath(MANAGED_MAC_CATALOGDIR)
         createPath(MANAGED_MAC_MANIFESTDIR)
+        createPath(MANAGED_MAC_PPDCACHEDIR)
 
 
 def createPath(path):
@@ -68,50 +83,511 @@ def createPath(path):
             sys.exit(1)
 
 
+MANAGED_MAC_RUN_LOCK = MANAGED_MAC_DIR + "/managedmac.lock"
+RUN_LOCK = None
+def acquireRunLock(timeout = 0):
+    """
+    Take the lock that keeps the scheduled, retry and daemon runs from
+    changing printers and state files at the same time. The lock is
+    held until the process exits. Waits up to timeout seconds for
+    another process to release it, or forever if timeout is None.
+    Returns False if the lock could not be taken in time.
+    """
+    global RUN_LOCK
+    import fcntl
+
+    if RUN_LOCK is not None:
+        return True
+
+    fp = open(MANAGED_MAC_RUN_LOCK, 'a')
+    if timeout is None:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+    else:
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError:
+                if time.time() >= deadline:
+                    fp.close()
+                    return False
+                time.sleep(1)
+
+    RUN_LOCK = fp
+    return True
+
+
+FOUNDATION = None
+def foundation():
+    """
+    Get the Foundation module, importing it the first time it is used.
+    Returns None if PyObjC is not available.
+    """
+    global FOUNDATION
+
+    if FOUNDATION is None:
+        try:
+            import Foundation
+            FOUNDATION = Foundation
+        except ImportError:
+            FOUNDATION = False
+
+    return FOUNDATION or None
+
+
+PLIST_BACKEND = None
+def plistBackend():
+    """
+    Get the name of the property list backend. The built in 'python'
+    reader and writer is used unless the PlistBackend preference asks
+    for 'foundation' and PyObjC is available.
+    """
+    global PLIST_BACKEND
+
+    if PLIST_BACKEND is None:
+        if pref('PlistBackend') == 'foundation' and foundation() is not None:
+            PLIST_BACKEND = 'foundation'
+        else:
+            PLIST_BACKEND = 'python'
+
+    return PLIST_BACKEND
+
+
 def readDictionary(filepath):
     """
-    Use Foundation calls to read a property list (dictionary)
-    from disk.
+    Read a property list (dictionary) from disk. Both XML and binary
+    property lists are accepted. Returns None if the file does not
+    exist or is not a dictionary.
+    """
+    if plistBackend() == 'foundation':
+        return foundation().NSDictionary.dictionaryWithContentsOfFile_(filepath)
+
+    try:
+        data = plist.readPlist(filepath)
+    except (IOError, plist.PlistError):
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    return data
+
+
+def writeDictionary(dict, filepath, binary = False):
+    """
+    Atomically write dictionary to disk as an XML property list, or a
+    binary property list if binary is True.
     """
-    return NSDictionary.dictionaryWithContentsOfFile_(filepath)
+    if plistBackend() == 'foundation':
+        Foundation = foundation()
+        if binary:
+            (data, error) = Foundation.NSPropertyListSerialization.dataWithPropertyList_format_options_error_(
+                    dict, Foundation.NSPropertyListBinaryFormat_v1_0, 0, None)
+            if data is None:
+                raise IOError('Could not serialize ' + filepath + ': ' + str(error))
+            data.writeToFile_atomically_(filepath, True)
+        else:
+            dictObj = Foundation.NSDictionary.dictionaryWithDictionary_(dict)
+            dictObj.writeToFile_atomically_(filepath, 1)
+        return
+
+    plist.writePlist(dict, filepath, binary)
+
+
+def mutableCopy(value):
+    """
+    Make a deep copy of a property list value using plain Python
+    dictionaries and lists so that it can be modified.
+    """
+    if hasattr(value, 'keys'):
+        return dict([ (key, mutableCopy(value[key])) for key in value.keys() ])
+    if isinstance(value, (list, tuple)) or (hasattr(value, '__iter__') and not isinstance(value, basestring)):
+        return [ mutableCopy(item) for item in value ]
+    return value
 
 
-def writeDictionary(dict, filepath):
+STORES = []
+class PlistStore(object):
     """
-    Write dictionary to disk using Foundation call.
+    Write-behind store for a property list state file. The file is read
+    once, on first use, and changes are kept in memory until flush() is
+    called, at which point the whole file is written back atomically
+    as a binary property list if anything changed. Callers that modify the data returned by
+    load() must hold lock and call markDirty().
     """
-    dictObj = NSDictionary.dictionaryWithDictionary_(dict)
-    dictObj.writeToFile_atomically_(filepath, 1)
 
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.data = None
+        self.dirty = False
+        STORES.append(self)
+
+    def load(self):
+        """
+        Get the in-memory copy of the property list.
+        """
+        with self.lock:
+            if self.data is None:
+                data = readDictionary(self.path)
+                self.data = mutableCopy(data) if data is not None else { }
+                self.dirty = False
+            return self.data
+
+    def get(self, key, default = None):
+        with self.lock:
+            return self.load().get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.load()[key] = value
+            self.dirty = True
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.load():
+                del self.data[key]
+                self.dirty = True
+
+    def markDirty(self):
+        with self.lock:
+            self.dirty = True
+
+    def flush(self):
+        """
+        Write the property list back to disk if it has changed.
+        """
+        with self.lock:
+            if self.dirty and self.data is not None:
+                writeDictionary(self.data, self.path, True)
+                self.dirty = False
+
+    def reset(self):
+        """
+        Flush any changes and drop the in-memory copy so the file is
+        read again on next use.
+        """
+        with self.lock:
+            self.flush()
+            self.data = None
+
+
+def flushStores():
+    """
+    Write all modified state stores to disk. This is a checkpoint that
+    is called at the end of each action.
+    """
+    for store in STORES:
+        try:
+            store.flush()
+        except Exception, e:
+            log('Could not save ' + store.path + ': ' + str(e))
 
-def download(url, destination_path = None):
+
+PARSED = {}
+PARSED_USED = set()
+def readCachedDictionary(filepath):
+    """
+    Read a property list from disk, re-using the previously parsed
+    copy if the file has not changed since it was last read.
+    """
+    try:
+        statinfo = os.stat(filepath)
+    except OSError:
+        PARSED.pop(filepath, None)
+        return None
+
+    key = (statinfo.st_mtime, statinfo.st_size)
+    PARSED_USED.add(filepath)
+    if filepath in PARSED and PARSED[filepath][0] == key:
+        metrics.increment('ParsedPlistHits')
+        return PARSED[filepath][1]
+
+    metrics.increment('ParsedPlistMisses')
+    data = readDictionary(filepath)
+    if data is not None:
+        PARSED[filepath] = (key, data)
+    return data
+
+
+def download(url, destination_path = None, checksum = None, max_size = None):
     """
     Download the given URL to the destination_path. If destination_path
     was not specified then a temporary file is generated. The path to
     the file is returned. If there was an error then an exception is
     raised.
-    """
-    url = urllib.urlopen(url)
 
-    if url.getcode() != 200 and url.getcode() is not None:
-        raise IOError('Invalid response received: ' + str(url.getcode()))
+    If checksum is given (e.g. "sha256:<hex digest>") the data is
+    verified as it is downloaded. If max_size is given, or the
+    MaxDownloadSize preference is set, larger downloads are aborted.
+    """
+    temp_path = None
+    if destination_path is None:
+        (fd, temp_path) = tempfile.mkstemp()
+        os.close(fd)
+        destination_path = temp_path
 
     try:
-        if destination_path is None:
-            (fd, filename) = tempfile.mkstemp()
-            os.close(fd)
-            destination_path = filename
-
-        with open(destination_path, 'wb') as fp:
-            fp.write(url.read(-1))
+        _fetch(url, destination_path, None, checksum, max_size)
     except:
+        if temp_path is not None:
+            try: os.remove(temp_path)
+            except OSError: pass
         raise
-    finally:
-        fp.close()
 
     return destination_path
 
 
+def downloadIfModified(url, destination_path, checksum = None, max_size = None, cached_path = None):
+    """
+    Download the given URL to destination_path only if it has changed
+    since the last download. The ETag and Last-Modified validators of
+    each URL are kept in the validator store and sent back to the server
+    so it can answer with a 304 when the local copy is still current.
+    If the local copy lives somewhere other than destination_path then
+    its location can be given in cached_path.
+    Returns True if new data was written to destination_path or False
+    if the local copy is already up to date. If there was an error then
+    an exception is raised.
+    """
+    if cached_path is None:
+        cached_path = destination_path
+
+    headers = { }
+    entry = loadValidators().get(url)
+    if entry is not None and validatorsMatchFile(entry, cached_path):
+        if checksum is None or fileMatchesChecksum(cached_path, checksum):
+            if 'ETag' in entry:
+                headers['If-None-Match'] = entry['ETag']
+            if 'LastModified' in entry:
+                headers['If-Modified-Since'] = entry['LastModified']
+
+    info = _fetch(url, destination_path, headers, checksum, max_size)
+    if info is None:
+        metrics.increment('ValidatorHits')
+        return False
+    metrics.increment('ValidatorMisses')
+
+    #
+    # Remember the new validators, if the server gave us any.
+    #
+    entry = { }
+    if info.getheader('ETag') is not None:
+        entry['ETag'] = info.getheader('ETag')
+    if info.getheader('Last-Modified') is not None:
+        entry['LastModified'] = info.getheader('Last-Modified')
+    if len(entry) > 0:
+        statinfo = os.stat(destination_path)
+        entry['Path'] = destination_path
+        entry['Size'] = statinfo.st_size
+        entry['MTime'] = int(statinfo.st_mtime)
+        VALIDATORS.set(url, entry)
+    else:
+        VALIDATORS.remove(url)
+
+    return True
+
+
+DOWNLOAD_CHUNK_SIZE = 65536
+
+
+class HTTPStatusError(IOError):
+    """
+    The server answered with a status other than 200 or 304.
+    """
+
+    def __init__(self, code):
+        IOError.__init__(self, 'Invalid response received: ' + str(code))
+        self.code = code
+
+
+class ChecksumError(IOError):
+    """
+    The downloaded data did not match the expected checksum.
+    """
+    pass
+
+
+class DownloadSizeError(IOError):
+    """
+    The download was larger than the allowed size.
+    """
+    pass
+
+
+def _fetch(url, destination_path, headers = None, checksum = None, max_size = None):
+    """
+    Perform the actual download of url into destination_path, sending
+    any extra request headers. HTTP and HTTPS downloads go through the
+    shared connection pool. The data is streamed in chunks to a
+    temporary file next to destination_path, which is only renamed
+    into place once the download completed and passed any checksum and
+    size checks. Returns the response headers or None if the server
+    replied that the resource has not been modified.
+    """
+    if max_size is None:
+        max_size = pref('MaxDownloadSize')
+    if checksum is not None:
+        (algorithm, expected) = parseChecksum(checksum)
+        digest = hashlib.new(algorithm)
+    else:
+        digest = None
+
+    start = time.time()
+    size = 0
+    if url[:7] == 'http://' or url[:8] == 'https://':
+        response = connectionPool().request(url, headers)
+    else:
+        import urllib2
+        request = urllib2.Request(url, headers = headers or { })
+        response = urllib2.urlopen(request)
+
+    temp_path = None
+    try:
+        if response.getcode() == 304:
+            response.read()
+            return None
+        if response.getcode() != 200 and response.getcode() is not None:
+            response.read()
+            raise HTTPStatusError(response.getcode())
+
+        length = response.info().getheader('Content-Length')
+        if max_size is not None and length is not None and length.isdigit() and int(length) > max_size:
+            raise DownloadSizeError('Download of ' + length + ' bytes exceeds the limit of ' + str(max_size) + ' bytes')
+
+        (fd, temp_path) = tempfile.mkstemp(dir = os.path.dirname(destination_path),
+                prefix = '.' + os.path.basename(destination_path) + '.')
+        with os.fdopen(fd, 'wb') as fp:
+            while True:
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise DownloadSizeError('Download exceeds the limit of ' + str(max_size) + ' bytes')
+                if digest is not None:
+                    digest.update(chunk)
+                fp.write(chunk)
+
+        if digest is not None and digest.hexdigest() != expected:
+            raise ChecksumError('Checksum mismatch, expected ' + expected + ' but received ' + digest.hexdigest())
+
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, destination_path)
+        temp_path = None
+    finally:
+        response.close()
+        metrics.recordDownload(url, time.time() - start, size, response.getcode())
+        if temp_path is not None:
+            try: os.remove(temp_path)
+            except: pass
+
+    return response.info()
+
+
+def parseChecksum(checksum):
+    """
+    Split a checksum in the form "algorithm:hexdigest" into its parts.
+    If no algorithm is given it is guessed from the digest length.
+    """
+    if checksum.find(':') != -1:
+        (algorithm, expected) = checksum.split(':', 1)
+        algorithm = algorithm.lower()
+    else:
+        expected = checksum
+        algorithm = { 32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512' }.get(len(checksum))
+
+    if algorithm is None or algorithm not in hashlib.algorithms:
+        raise ValueError('Unsupported checksum: ' + checksum)
+
+    return (algorithm, expected.strip().lower())
+
+
+def fileMatchesChecksum(path, checksum):
+    """
+    Check if the file at path matches the given checksum.
+    """
+    (algorithm, expected) = parseChecksum(checksum)
+    digest = hashlib.new(algorithm)
+    try:
+        with open(path, 'rb') as fp:
+            while True:
+                chunk = fp.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    except IOError:
+        return False
+
+    return digest.hexdigest() == expected
+
+
+POOL = None
+POOL_LOCK = threading.Lock()
+def connectionPool():
+    """
+    Get the keep-alive connection pool used for all repo downloads
+    during this run.
+    """
+    global POOL
+
+    with POOL_LOCK:
+        if POOL is None:
+            from mmlib import httppool
+            POOL = httppool.ConnectionPool(pref('MaxConnectionsPerHost'))
+
+    return POOL
+
+
+def logConnectionStats():
+    """
+    Log the connection pool counters for this run.
+    """
+    if POOL is not None:
+        log('Connection pool: ' + POOL.summary())
+
+
+VALIDATORS = PlistStore(MANAGED_MAC_VALIDATORS_PLIST)
+def loadValidators():
+    """
+    Load the ETag/Last-Modified validator store. The store maps each
+    URL to the validators of the local copy it was saved to.
+    """
+    return VALIDATORS.load()
+
+
+def relocateValidators(url, path):
+    """
+    Update the validator store after the local copy of url has been
+    moved to path.
+    """
+    with VALIDATORS.lock:
+        entry = VALIDATORS.get(url)
+        if entry is not None:
+            statinfo = os.stat(path)
+            entry['Path'] = path
+            entry['Size'] = statinfo.st_size
+            entry['MTime'] = int(statinfo.st_mtime)
+            VALIDATORS.markDirty()
+
+
+def validatorsMatchFile(entry, path):
+    """
+    Check that the local file at path is still the one the validators
+    were recorded for. If some other URL wrote to the file since then
+    the validators cannot be used.
+    """
+    if entry.get('Path') != path:
+        return False
+
+    try:
+        statinfo = os.stat(path)
+    except OSError:
+        return False
+
+    return statinfo.st_size == entry.get('Size') and int(statinfo.st_mtime) == entry.get('MTime')
+
+
 def systemIdleTimer():
     """
     Return idle time in seconds.
@@ -138,45 +614,234 @@ def systemSerialNumber():
     """
     Return the SerialNumber of the system.
     """
-
-    # Get the output from 
-    # ioreg -c IOPlatformExpertDevice
-    s = subprocess.Popen(["ioreg", "-c", "IOPlatformExpertDevice"], stdout=subprocess.PIPE).communicate()[0]
-    lines = s.split('\n')
-
-    matches = re.findall('.*\"IOPlatformSerialNumber\" = \"(.*)\"', s)
-    return "" if len(matches) == 0 else matches[0]
+    from mmlib import facts
+    return facts.get('SerialNumber', "")
 
 
 def pref(pref_name, default = None):
     default_prefs = {
         'RepoURL': 'http://munki/managedmac',
         'ClientIdentifier': '',
+        'DownloadWorkers': 4,
+        'MaxConnectionsPerHost': 4,
+        'MaxDownloadSize': None,
+        'PPDCacheSize': 100 * 1024 * 1024,
+        'PrinterBackend': 'ipp',
+        'PrinterWorkers': 4,
+        'PrinterVerifyInterval': 24 * 3600,
+        'ODNode': '/LDAPv3/ldap.hdcnet.org',
+        'MissingManifestTTL': 24 * 3600,
+        'RunLockTimeout': 900,
+        'StaleWhileRevalidate': False,
+        'MaxStaleness': 24 * 3600,
+        'MetricsHistory': 500,
+        'ActionWorkers': 4,
+        'StartupBudget': 1.0,
+        'PlistBackend': 'python',
+        'DaemonInterval': 3600,
+        'DaemonActionIntervals': { },
+        'DaemonRepoInterval': 3600,
+        'DaemonRetryInterval': 300,
+        'DaemonSplay': 300,
+        'DaemonBackoff': 60,
+        'DaemonMaxBackoff': 4 * 3600,
+        'DaemonMaxMemory': 256,
     }
-    pref_value = CFPreferencesCopyAppValue(pref_name, BUNDLE_ID)
+    if foundation() is not None:
+        pref_value = foundation().CFPreferencesCopyAppValue(pref_name, BUNDLE_ID)
+    else:
+        pref_value = filePreferences().get(pref_name)
     if pref_value == None:
         pref_value = default_prefs.get(pref_name)
     return pref_value
 
 
+FILE_PREFERENCES = None
+def filePreferences():
+    """
+    Read the preferences straight from the preferences file, used when
+    CFPreferences is not available.
+    """
+    global FILE_PREFERENCES
+
+    if FILE_PREFERENCES is None:
+        try:
+            FILE_PREFERENCES = plist.readPlist(MANAGED_MAC_PREFERENCES_PLIST)
+        except (IOError, plist.PlistError):
+            FILE_PREFERENCES = { }
+
+    return FILE_PREFERENCES
+
+
+LOG_MAX_SIZE = 1000000
+LOG_ROTATIONS = 5
+LOG_BUFFER_SIZE = 8192
+LOG_FLUSH_INTERVAL = 2.0
+
+
+class LogWriter(object):
+    """
+    Writes log lines to a file that is kept open for the whole run.
+    Lines are buffered and written out once the buffer is full, after
+    LOG_FLUSH_INTERVAL seconds or when the program exits. The size of
+    the file is tracked as it is written so the rotation check does not
+    need to stat the file. Rotated logs are gzip compressed in a
+    background thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = None
+        self.size = 0
+        self.buffer = [ ]
+        self.buffered = 0
+        self.timer = None
+        self.compressor = None
+        self.lock = threading.RLock()
+
+    def write(self, line):
+        with self.lock:
+            self.buffer.append(line)
+            self.buffered += len(line)
+            if self.buffered >= LOG_BUFFER_SIZE:
+                self.flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(LOG_FLUSH_INTERVAL, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if len(self.buffer) == 0:
+                return
+
+            data = ''.join(self.buffer)
+            self.buffer = [ ]
+            self.buffered = 0
+            try:
+                if self.fp is None:
+                    self.fp = open(self.path, 'a')
+                    self.size = os.fstat(self.fp.fileno()).st_size
+                self.fp.write(data)
+                self.fp.flush()
+                self.size += len(data)
+                if self.size > LOG_MAX_SIZE:
+                    self.rotate()
+            except (IOError, OSError):
+                pass
+
+    def rotate(self):
+        """
+        Move the current log to .0 and shift the older logs up, keeping
+        LOG_ROTATIONS of them. The new .0 log is compressed to .0.gz in
+        the background.
+        """
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+            if self.compressor is not None:
+                self.compressor.join()
+
+            try:
+                for suffix in [ '', '.gz' ]:
+                    last = self.path + "." + str(LOG_ROTATIONS) + suffix
+                    if os.path.exists(last):
+                        os.remove(last)
+                for x in range(LOG_ROTATIONS - 1, -1, -1):
+                    for suffix in [ '', '.gz' ]:
+                        name = self.path + "." + str(x) + suffix
+                        if os.path.exists(name):
+                            os.rename(name, self.path + "." + str(x + 1) + suffix)
+                os.rename(self.path, self.path + ".0")
+            except OSError:
+                return
+
+            self.compressor = threading.Thread(target = compressFile, args = (self.path + ".0",))
+            self.compressor.start()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+            if self.compressor is not None:
+                self.compressor.join()
+                self.compressor = None
+
+
+def compressFile(path):
+    """
+    Gzip compress the file at path to path.gz and remove the original.
+    """
+    import gzip
+    import shutil
+
+    try:
+        with open(path, 'rb') as source:
+            with gzip.open(path + '.gz.tmp', 'wb') as destination:
+                shutil.copyfileobj(source, destination)
+        os.rename(path + '.gz.tmp', path + '.gz')
+        os.remove(path)
+    except (IOError, OSError):
+        pass
+
+
+LOG_WRITER = None
+LOG_LOCK = threading.RLock()
+LOG_CONTEXT = threading.local()
 def log(message):
+    global LOG_WRITER
+
     timestamp = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S] ")
-    if log_console:
-        print timestamp + log_module_name + ": " + message
-    with open(MANAGED_MAC_LOGFILE, "a") as fp:
-        fp.write(timestamp + log_module_name + ": " + message + "\n")
+    tag = getattr(LOG_CONTEXT, 'tag', None)
+    if tag is not None:
+        message = "[" + tag + "] " + message
+
+    module = logModule()
+    with LOG_LOCK:
+        if log_console:
+            print timestamp + module + ": " + message
+        if LOG_WRITER is None:
+            LOG_WRITER = LogWriter(MANAGED_MAC_LOGFILE)
+            atexit.register(LOG_WRITER.close)
+        LOG_WRITER.write(timestamp + module + ": " + message + "\n")
+
+
+def flushLog():
+    """
+    Write out any buffered log messages.
+    """
+    if LOG_WRITER is not None:
+        LOG_WRITER.flush()
+
+
+def setLogTag(tag):
+    """
+    Tag every log message written by the current thread, for example
+    with the name of the printer being worked on. Pass None to clear.
+    """
+    LOG_CONTEXT.tag = tag
 
-    statinfo = os.stat(MANAGED_MAC_LOGFILE)
-    if statinfo.st_size > 1000000:
-        try:
-            if os.path.exists(MANAGED_MAC_LOGFILE + ".5"):
-                os.remove(MANAGED_MAC_LOGFILE + ".5")
-            for x in [4, 3, 2, 1, 0]:
-                if os.path.exists(MANAGED_MAC_LOGFILE + "." + str(x)):
-                    os.rename(MANAGED_MAC_LOGFILE + "." + str(x), MANAGED_MAC_LOGFILE + "." + str(x + 1))
-            os.rename(MANAGED_MAC_LOGFILE, MANAGED_MAC_LOGFILE + ".0")
-        except:
-            pass
+
+def setLogModule(name):
+    """
+    Set the module name that log messages written by the current thread
+    are attributed to. Pass None to go back to log_module_name.
+    """
+    LOG_CONTEXT.module = name
+
+
+def logModule():
+    """
+    Get the module name log messages of the current thread are
+    attributed to.
+    """
+    return getattr(LOG_CONTEXT, 'module', None) or log_module_name
 
 
 def valueForKeyPath(dict, keypath, default = None):
@@ -192,32 +857,513 @@ def valueForKeyPath(dict, keypath, default = None):
     return dict
 
 
-def updateRepo():
+def parallelMap(func, items, workers = None):
     """
-    Download the manifest and catalogs for this client.
+    Call func for each item using a bounded pool of worker threads and
+    return the results in the same order as items. If func raises an
+    exception for an item then the error is logged and the result for
+    that item is None.
     """
-    getManifest()
-    processManifestKeyPath(None, None, None, None)
+    if workers is None:
+        workers = pref('DownloadWorkers')
+    workers = max(1, min(int(workers), len(items)))
+    if serial:
+        workers = 1
+
+    results = [ None ] * len(items)
+    if len(items) == 0:
+        return results
+
+    queue = Queue.Queue()
+    for index in range(len(items)):
+        queue.put(index)
+
+    #
+    # Worker threads log under the same module as the caller.
+    #
+    module = getattr(LOG_CONTEXT, 'module', None)
+
+    def worker():
+        setLogModule(module)
+        while True:
+            try:
+                index = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(items[index])
+            except Exception, e:
+                log('Error processing ' + str(items[index]) + ': ' + str(e))
+
+    #
+    # A single worker runs in the calling thread, this keeps the work
+    # visible to a profiler attached to that thread.
+    #
+    if workers == 1:
+        worker()
+        return results
+
+    threads = [ threading.Thread(target = worker) for i in range(workers) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+#
+# Records, per thread, whether the server answered during the last
+# updateRepo() call. The local copies are used when it does not, so the
+# result of updateRepo() alone does not say the repo is up to date.
+#
+REPO_CONTACT = threading.local()
+def updateRepo(cache = True):
+    """
+    Download the manifest and catalogs for this client. Returns False
+    if there is no client manifest to work from. If the repo has an
+    index that has not changed since the last complete update then
+    every local copy is already current and the repo is not walked.
+    With cache set to False only the local copies on disk are updated,
+    the copies in memory are left alone. Afterwards repoAnswered()
+    tells if the server was actually reached.
+    """
+    status = None
+    REPO_CONTACT.answered = False
+    if not offline:
+        status = loadRepoIndex()
+        REPO_CONTACT.answered = status is not None
+    if status == 'unchanged':
+        log('Repo index has not changed since the last update')
+        result = getManifest(None, cache) is not None
+    else:
+        result = prefetchRepo(cache)
+        if status == 'changed' and result:
+            commitRepoIndex()
+
+    if result and repoAnswered():
+        REPO_STATE.set('Updated', int(time.time()))
+
+    return result
+
+
+def repoAnswered():
+    """
+    Check if the server answered during the last updateRepo() call made
+    by this thread, either with the repo index or the client manifest.
+    """
+    return getattr(REPO_CONTACT, 'answered', False)
+
+
+MANAGED_MAC_REPO_STATE_PLIST = MANAGED_MAC_DIR + "/RepoState.plist"
+REPO_STATE = PlistStore(MANAGED_MAC_REPO_STATE_PLIST)
+def repoAge():
+    """
+    Get the number of seconds since the local copies of the repo were
+    last brought up to date with the server, or None if they never were.
+    """
+    updated = REPO_STATE.get('Updated')
+    if updated is None:
+        return None
+
+    return time.time() - updated
+
+
+def loadStaleRepo():
+    """
+    Load the manifests and catalogs from their local copies without
+    asking the server, as long as they were brought up to date no more
+    than MaxStaleness seconds ago. Returns True if the local copies
+    were loaded.
+    """
+    global offline
+
+    age = repoAge()
+    if age is None or age > pref('MaxStaleness'):
+        return False
+
+    offline = True
+    try:
+        result = updateRepo()
+    finally:
+        offline = False
+
+    if not result:
+        resetRepo()
+    return result
+
+
+class Revalidation(object):
+    """
+    Brings the local copies of the repo up to date with the server in a
+    background thread, without touching the copies in memory that the
+    actions are working from.
+    """
+
+    def __init__(self):
+        self.result = None
+        self.answered = False
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.result = updateRepo(False)
+            self.answered = repoAnswered()
+        except Exception, e:
+            log('Revalidating the repo failed: ' + str(e))
+            self.result = False
+
+    def finish(self):
+        """
+        Wait for the revalidation and load the refreshed copies into
+        memory. Returns True if they differ from the copies the actions
+        worked from.
+        """
+        global offline
+
+        self.thread.join()
+        if not self.result or not self.answered:
+            log('Could not revalidate the repo, keeping the local copies')
+            return False
+
+        previous = (dict(MANIFESTS), dict(CATALOGS))
+        resetRepo()
+        offline = True
+        try:
+            updateRepo()
+
+            #
+            # The actions may have loaded manifests and catalogs that the
+            # walk does not reach, load those too so both sides match.
+            #
+            for name in previous[0]:
+                if name != 'client_manifest' and name not in MANIFESTS:
+                    getManifest(name)
+            for name in previous[1]:
+                if name not in CATALOGS:
+                    getCatalog(name)
+        finally:
+            offline = False
+
+        return (dict(MANIFESTS), dict(CATALOGS)) != previous
+
+
+REPO_INDEX = None
+def loadRepoIndex():
+    """
+    Download the optional index.plist at the root of the repo. The index
+    lists each manifest and catalog with the hash and size of its
+    content, for example:
+
+        manifests => { site_default => { hash => "sha256:...", size => 1234 } }
+        catalogs => { production => { hash => "sha256:...", size => 5678 } }
+
+    A new index is downloaded next to the current one and only replaces
+    it once the repo has been updated from it, see commitRepoIndex().
+    Returns 'changed' or 'unchanged', or None if the repo has no index.
+    """
+    global REPO_INDEX
+
+    url = pref('RepoURL') + '/index.plist'
+    staging_path = MANAGED_MAC_REPO_INDEX_PLIST + '.new'
+    cached_path = None
+    if os.path.exists(MANAGED_MAC_REPO_INDEX_PLIST):
+        cached_path = MANAGED_MAC_REPO_INDEX_PLIST
+
+    REPO_INDEX = None
+    try:
+        if downloadIfModified(url, staging_path, None, None, cached_path) == False:
+            REPO_INDEX = readCachedDictionary(MANAGED_MAC_REPO_INDEX_PLIST)
+            status = 'unchanged'
+        else:
+            REPO_INDEX = readCachedDictionary(staging_path)
+            status = 'changed'
+    except Exception, e:
+        #
+        # Most repos do not have an index, so a missing one is only
+        # mentioned in verbose output.
+        #
+        if log_console or not (isinstance(e, HTTPStatusError) and e.code == 404):
+            log('Repo index not available: ' + str(e))
+        return None
+
+    if REPO_INDEX is None:
+        return None
+
+    return status
+
+
+def commitRepoIndex():
+    """
+    Make the index downloaded by loadRepoIndex() the current one, now
+    that the local copies have been brought up to date with it.
+    """
+    staging_path = MANAGED_MAC_REPO_INDEX_PLIST + '.new'
+    try:
+        os.rename(staging_path, MANAGED_MAC_REPO_INDEX_PLIST)
+        relocateValidators(pref('RepoURL') + '/index.plist', MANAGED_MAC_REPO_INDEX_PLIST)
+    except OSError, e:
+        log('Could not save the repo index: ' + str(e))
+
+
+def repoCopyIsCurrent(kind, name, path):
+    """
+    Check the repo index to see if the local copy at path of the named
+    manifest or catalog (kind is 'manifests' or 'catalogs') is the same
+    as the copy on the server, in which case the server need not be
+    asked about it.
+    """
+    if REPO_INDEX is None:
+        return False
+
+    entry = (REPO_INDEX.get(kind) or { }).get(name)
+    current = False
+    if entry is not None and entry.get('hash'):
+        try:
+            statinfo = os.stat(path)
+            if statinfo.st_size == entry.get('size'):
+                current = (localChecksum(path, statinfo, entry['hash']) == entry['hash'])
+        except (OSError, IOError, ValueError):
+            pass
+
+    metrics.increment('RepoIndexHits' if current else 'RepoIndexMisses')
+    return current
+
+
+CHECKSUMS = {}
+def localChecksum(path, statinfo, checksum):
+    """
+    Calculate the checksum of the file at path using the same algorithm
+    as checksum, in the same "algorithm:hexdigest" form. Results are
+    remembered until the file changes.
+    """
+    (algorithm, expected) = parseChecksum(checksum)
+    key = (statinfo.st_mtime, statinfo.st_size, algorithm)
+    if path in CHECKSUMS and CHECKSUMS[path][0] == key:
+        return CHECKSUMS[path][1]
+
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+    value = algorithm + ':' + digest.hexdigest()
+    CHECKSUMS[path] = (key, value)
+    return value
+
+
+def resetRepo():
+    """
+    Forget the manifests and catalogs loaded so far so that the next
+    updateRepo() checks them with the server again. Parsed files that
+    were not read since the last reset are dropped from PARSED, which
+    keeps a long running process from holding on to files the repo no
+    longer uses.
+    """
+    global RESOLVED
+    global CATALOGS_GENERATION
+
+    MANIFESTS.clear()
+    CATALOGS.clear()
+    CATALOG_INDEXES.clear()
+    CATALOGS_GENERATION += 1
+    RESOLVED = None
+    for filepath in PARSED.keys():
+        if filepath not in PARSED_USED:
+            del PARSED[filepath]
+    PARSED_USED.clear()
+
+
+def prefetchRepo(cache = True):
+    """
+    Walk the included_manifests graph breadth-first starting at the
+    client manifest. Each level of manifests, along with any catalogs
+    they reference, is downloaded in parallel so that MANIFESTS and
+    CATALOGS are filled before any action runs.
+    """
+    manifest = getManifest(None, cache)
+    if manifest is None:
+        return False
+
+    graph = { None: manifest.get('included_manifests') or [ ] }
+    seen_manifests = [ ]
+    seen_catalogs = [ ]
+    level = [ manifest ]
+
+    while len(level) > 0:
+        tasks = [ ]
+        for manifest in level:
+            for name in manifest.get('catalogs') or [ ]:
+                if name not in seen_catalogs:
+                    seen_catalogs.append(name)
+                    tasks.append(('catalog', name, cache))
+            for name in manifest.get('included_manifests') or [ ]:
+                if name not in seen_manifests:
+                    seen_manifests.append(name)
+                    tasks.append(('manifest', name, cache))
+
+        results = parallelMap(_prefetchItem, tasks)
+
+        level = [ ]
+        for (task, data) in zip(tasks, results):
+            if task[0] == 'manifest' and data is not None:
+                graph[task[1]] = data.get('included_manifests') or [ ]
+                level.append(data)
+
+    for cycle in findManifestCycles(graph):
+        log('Cycle detected in included_manifests: ' + ' -> '.join(cycle))
+
+    return True
+
+
+def _prefetchItem(task):
+    """
+    Download a single ('manifest', name, cache) or ('catalog', name,
+    cache) item.
+    """
+    if task[0] == 'catalog':
+        return getCatalog(task[1], task[2])
+    return getManifest(task[1], task[2])
+
+
+def findManifestCycles(graph):
+    """
+    Find cycles in a graph of manifest name to included manifest names.
+    The client manifest is keyed by None. Returns a list of cycles, each
+    being the list of manifest names that make up the loop.
+    """
+    cycles = [ ]
+    state = { }
+
+    def visit(name, path):
+        state[name] = 'visiting'
+        for child in graph.get(name, [ ]):
+            if state.get(child) == 'visiting':
+                cycles.append(path[path.index(child):] + [ child ])
+            elif child not in state:
+                visit(child, path + [ child ])
+        state[name] = 'done'
+
+    visit(None, [ ])
+
+    return cycles
+
+
+MANAGED_MAC_IDENTIFIERS_PLIST = MANAGED_MAC_DIR + "/ManifestIdentifiers.plist"
+IDENTIFIERS = PlistStore(MANAGED_MAC_IDENTIFIERS_PLIST)
+def resolveClientManifest(baseurl, identifiers):
+    """
+    Find the first of identifiers that the server has a manifest for
+    and make it the local client manifest. Identifiers the server
+    recently answered 404 for are skipped until MissingManifestTTL
+    runs out, which should be well over the interval between runs so
+    the skip lasts across runs. If the identifier that worked last
+    time is the first one left it is tried on its own, otherwise the
+    remaining identifiers are all requested at the same time and the
+    first in the list that succeeds is used. Returns True if a
+    manifest was found.
+    """
+    identifiers = [ i for (n, i) in enumerate(identifiers) if i and i not in identifiers[:n] ]
+    if len(identifiers) == 0:
+        return False
+
+    now = int(time.time())
+    with IDENTIFIERS.lock:
+        state = IDENTIFIERS.load()
+        missing = state.setdefault('Missing', { })
+        winner = state.get('Identifier')
+        candidates = identifiers
+        if REPO_INDEX is None:
+            candidates = [ i for i in identifiers if now - missing.get(i, 0) >= pref('MissingManifestTTL') ]
+            if len(candidates) == 0:
+                candidates = identifiers
+
+    if candidates[0] == winner:
+        results = [ probeManifest(baseurl, winner) ]
+        if results[0][0] not in ('new', 'current'):
+            rest = candidates[1:]
+            results += parallelMap(lambda identifier: probeManifest(baseurl, identifier), rest, pref('DownloadWorkers'))
+            candidates = [ winner ] + rest
+    else:
+        results = parallelMap(lambda identifier: probeManifest(baseurl, identifier), candidates, pref('DownloadWorkers'))
+
+    found = None
+    with IDENTIFIERS.lock:
+        for (identifier, (status, path)) in zip(candidates, results):
+            if status == 'missing':
+                missing[identifier] = now
+            elif identifier in missing and status != 'failed':
+                del missing[identifier]
+
+            if found is None and status in ('new', 'current'):
+                found = identifier
+                if status == 'new':
+                    os.rename(path, MANAGED_MAC_MANIFEST_PLIST)
+                    relocateValidators(baseurl + identifier, MANAGED_MAC_MANIFEST_PLIST)
+            elif status == 'new':
+                os.remove(path)
+                VALIDATORS.remove(baseurl + identifier)
+
+        if found is not None:
+            REPO_CONTACT.answered = True
+        if found is not None and found != winner:
+            log('Using manifest ' + found)
+            state['Identifier'] = found
+        IDENTIFIERS.markDirty()
+
+    return found is not None
+
+
+def probeManifest(baseurl, identifier):
+    """
+    Ask the server for the manifest of one identifier. The manifest is
+    downloaded next to the client manifest. Returns a tuple of the
+    result, which is one of 'new', 'current', 'missing' or 'failed',
+    and the path to the downloaded copy.
+    """
+    url = baseurl + identifier
+    path = MANAGED_MAC_MANIFESTDIR + '/.probe-' + hashlib.md5(identifier).hexdigest()
+
+    log("Downloading manifest from " + url)
+    try:
+        if downloadIfModified(url, path, None, None, MANAGED_MAC_MANIFEST_PLIST) == False:
+            log("Manifest has not changed since last download")
+            return ('current', None)
+        return ('new', path)
+    except HTTPStatusError, e:
+        log("Download failed: " + str(e))
+        return ('missing' if e.code == 404 else 'failed', None)
+    except Exception, e:
+        log("Download failed: " + str(e))
+        return ('failed', None)
 
 
 MANIFESTS = {}
-def getManifest(manifest_name = None):
+def getManifest(manifest_name = None, cache = True):
     """
-    Download a client manifest.
+    Download a client manifest. With cache set to False the manifest
+    is checked with the server and read from disk without using or
+    changing the copies kept in memory.
     """
-    global MANIFESTS
+    manifests = MANIFESTS if cache else { }
     baseurl = pref("RepoURL") + '/manifests/'
 
     if manifest_name is None:
-        if 'client_manifest' in MANIFESTS:
-            return MANIFESTS['client_manifest']
+        if 'client_manifest' in manifests:
+            return manifests['client_manifest']
 
         #
         # Make a list of the identifiers to try.
         #
         identifiers = [ ]
         if pref('ClientIdentifier') == "" or pref('UniqueIdentifiersFirst') == True:
-            hostname = platform.node()
+            from mmlib import facts
+            hostname = facts.get('Hostname', "")
             identifiers = [ hostname ]
             if hostname.find('.') != -1:
                 identifiers += [ hostname.split(".")[0] ]
@@ -227,81 +1373,106 @@ def getManifest(manifest_name = None):
             identifiers += [ pref("ClientIdentifier") ]
 
         #
-        # Try each of the identifiers until we find one that works.
+        # Try the identifiers until we find one that works. When
+        # running offline go straight to the local copy.
         #
-        for identifier in identifiers:
-            url = baseurl + identifier
-            log("Downloading manifest from " + url)
-            try:
-                download(url, MANAGED_MAC_MANIFEST_PLIST)
-                data = readDictionary(MANAGED_MAC_MANIFEST_PLIST)
+        if offline:
+            identifiers = [ ]
+
+        #
+        # With a repo index there is no need to ask the server about
+        # identifiers it does not have.
+        #
+        if REPO_INDEX is not None:
+            indexed = [ i for i in identifiers if i in (REPO_INDEX.get('manifests') or { }) ]
+            if len(indexed) > 0:
+                identifiers = indexed
+            if len(identifiers) > 0 and repoCopyIsCurrent('manifests', identifiers[0], MANAGED_MAC_MANIFEST_PLIST):
+                data = readCachedDictionary(MANAGED_MAC_MANIFEST_PLIST)
                 if data is not None:
-                    MANIFESTS['client_manifest'] = data
-                return data
-            except Exception, e:
-                log("Download failed: " + str(e))
-                pass
+                    manifests['client_manifest'] = data
+                    return data
+
+        if len(identifiers) > 0 and resolveClientManifest(baseurl, identifiers):
+            data = readCachedDictionary(MANAGED_MAC_MANIFEST_PLIST)
+            if data is not None:
+                manifests['client_manifest'] = data
+            return data
 
         #
         # Try to use the local copy instead.
         #
         try:
-            data = readDictionary(MANAGED_MAC_MANIFEST_PLIST)
+            data = readCachedDictionary(MANAGED_MAC_MANIFEST_PLIST)
             if data is not None:
-                MANIFESTS['client_manifest'] = data
+                manifests['client_manifest'] = data
             return data
         except:
-            MANIFESTS['client_manifest'] = None
+            manifests['client_manifest'] = None
             return None
     else:
         url = baseurl + manifest_name
         path = MANAGED_MAC_MANIFESTDIR + '/' + manifest_name
 
-        if manifest_name in MANIFESTS:
-            return MANIFESTS[manifest_name]
+        if manifest_name in manifests:
+            return manifests[manifest_name]
 
-        log('Downloading manifest from ' + url)
-        try:
-            download(url, path)
-        except Exception, e:
-            log("Download failed: " + str(e))
+        if not offline and not repoCopyIsCurrent('manifests', manifest_name, path):
+            log('Downloading manifest from ' + url)
+            try:
+                if downloadIfModified(url, path) == False:
+                    log("Manifest has not changed since last download")
+            except Exception, e:
+                log("Download failed: " + str(e))
 
         try:
-            data = readDictionary(path)
+            data = readCachedDictionary(path)
             if data is not None:
-                MANIFESTS[manifest_name] = data
+                manifests[manifest_name] = data
             return data
         except:
-            MANIFESTS[manifest_name] = None
+            manifests[manifest_name] = None
             return None
 
 
+#
+# CATALOGS_GENERATION changes whenever a catalog is loaded into CATALOGS
+# so that indexes built from older copies are not used.
+#
 CATALOGS = {}
-def getCatalog(catalog_name = None):
+CATALOGS_GENERATION = 0
+def getCatalog(catalog_name = None, cache = True):
     """
-    Download a catalog.
+    Download a catalog. With cache set to False the catalog is checked
+    with the server and read from disk without using or changing the
+    copies kept in memory.
     """
-    global CATALOGS
+    global CATALOGS_GENERATION
+
+    catalogs = CATALOGS if cache else { }
+    if catalog_name in catalogs:
+        return catalogs[catalog_name]
+
     baseurl = pref("RepoURL") + '/catalogs/'
     url = baseurl + catalog_name
     path = MANAGED_MAC_CATALOGDIR + '/' + catalog_name
 
-    if catalog_name in CATALOGS:
-        return CATALOGS[catalog_name]
-
-    log('Downloading catalog from ' + url)
-    try:
-        download(url, path)
-    except Exception, e:
-        log("Download failed: " + str(e))
+    if not offline and not repoCopyIsCurrent('catalogs', catalog_name, path):
+        log('Downloading catalog from ' + url)
+        try:
+            if downloadIfModified(url, path) == False:
+                log("Catalog has not changed since last download")
+        except Exception, e:
+            log("Download failed: " + str(e))
 
     try:
-        data = readDictionary(path)
-        if data is not None:
+        data = readCachedDictionary(path)
+        if data is not None and cache:
             CATALOGS[catalog_name] = data
+            CATALOGS_GENERATION += 1
         return data
     except:
-        CATALOGS[catalog_name] = None
+        catalogs[catalog_name] = None
         return None
 
 
@@ -321,65 +1492,204 @@ def processManualRun(manifest_name, runinfo, handler, userinfo, parentcatalogs =
     and have it ready for the handler
     """
 
-    manifest = getManifest(manifest_name)
-    if manifest is None:
-        return None
+    if manifest_name is None and parentcatalogs is None:
+        resolved = resolvedManifest()
+        if resolved.manifest is None:
+            return None
+        cataloglist = resolved.catalogs
+    else:
+        manifest = getManifest(manifest_name)
+        if manifest is None:
+            return None
 
-    cataloglist = manifest.get('catalogs')
-    if cataloglist:
-        getCatalogs(cataloglist)
-    elif parentcatalogs:
-        cataloglist = parentcatalogs
+        cataloglist = manifest.get('catalogs')
+        if cataloglist:
+            getCatalogs(cataloglist)
+        elif parentcatalogs:
+            cataloglist = parentcatalogs
 
     handler(userinfo, cataloglist, runinfo)
 
 
-def processManifestKeyPath(manifest_name, keypath, runinfo, handler, parentcatalogs = None):
+def processManifestKeyPath(manifest_name, keypath, runinfo, handler, parentcatalogs = None, parents = None):
     """
     Process the all the values of keypath in the manifest. For each
-    item call the handler. Recursively checks included manifests.
+    item call the handler. Included manifests are processed first, in
+    order, followed by the manifest itself.
     """
+    if manifest_name is None and parentcatalogs is None and parents is None:
+        resolved = resolvedManifest()
+    else:
+        resolved = ResolvedManifest(manifest_name, parentcatalogs, parents)
 
-    manifest = getManifest(manifest_name)
-    if manifest is None:
-        return None
+    for (item, cataloglist) in resolved.items(keypath):
+        handler(item, cataloglist, runinfo)
 
-    cataloglist = manifest.get('catalogs')
-    if cataloglist:
-        getCatalogs(cataloglist)
-    elif parentcatalogs:
-        cataloglist = parentcatalogs
 
-    #
-    # Check for nested manifests
-    #
-    if 'included_manifests' in manifest:
-        for item in manifest['included_manifests']:
-            processManifestKeyPath(item, keypath, runinfo, handler, cataloglist)
+class ResolvedManifest(object):
+    """
+    A manifest with its included_manifests flattened into a list of
+    nodes in processing order: the included manifests of a manifest,
+    depth first, then the manifest itself. A manifest included more
+    than once appears more than once. A manifest that includes itself,
+    directly or through others, is skipped. Each node carries its
+    effective catalog list, which is its own catalogs or, if it has
+    none, those of the manifest that included it.
+    """
 
-    #
-    # Process the keys.
-    #
-    if keypath is not None:
-        items = valueForKeyPath(manifest, keypath)
-        if items is not None:
-            try:
-                for item in items:
-                    handler(item, cataloglist, runinfo)
-            except TypeError:
-                handler(items, cataloglist, runinfo)
+    def __init__(self, manifest_name = None, parentcatalogs = None, parents = None):
+        self.nodes = [ ]
+        self.keypaths = { }
+        self.lock = threading.Lock()
+        self.manifest = getManifest(manifest_name)
+        self.catalogs = None
+        if self.manifest is not None:
+            self.catalogs = self.resolve(manifest_name, self.manifest, parentcatalogs, parents or [ ])
+
+    def resolve(self, manifest_name, manifest, parentcatalogs, parents):
+        """
+        Add manifest and the manifests it includes to the node list.
+        Returns the effective catalog list of manifest.
+        """
+        cataloglist = manifest.get('catalogs')
+        if cataloglist:
+            getCatalogs(cataloglist)
+        elif parentcatalogs:
+            cataloglist = parentcatalogs
+
+        for item in manifest.get('included_manifests') or [ ]:
+            if item in parents + [ manifest_name ]:
+                log('Skipping included manifest ' + item + ', it includes itself.')
+                continue
+            included = getManifest(item)
+            if included is not None:
+                self.resolve(item, included, cataloglist, parents + [ manifest_name ])
+
+        self.nodes.append((manifest_name, manifest, cataloglist))
+
+        return cataloglist
+
+    def items(self, keypath):
+        """
+        Get the list of (item, cataloglist) pairs for the values of
+        keypath in all the nodes. The list is built on first use.
+        """
+        if keypath is None:
+            return [ ]
+
+        with self.lock:
+            if keypath not in self.keypaths:
+                result = [ ]
+                for (name, manifest, cataloglist) in self.nodes:
+                    items = valueForKeyPath(manifest, keypath)
+                    if items is not None:
+                        try:
+                            result += [ (item, cataloglist) for item in items ]
+                        except TypeError:
+                            result.append((items, cataloglist))
+                self.keypaths[keypath] = result
+
+            return self.keypaths[keypath]
+
+
+RESOLVED = None
+RESOLVED_LOCK = threading.Lock()
+def resolvedManifest():
+    """
+    Get the ResolvedManifest of the client manifest, it is built once
+    and shared until resetRepo() is called.
+    """
+    global RESOLVED
+
+    with RESOLVED_LOCK:
+        if RESOLVED is None:
+            RESOLVED = ResolvedManifest()
+        return RESOLVED
 
 
 def getFirstCatalogKeyPath(cataloglist, keypath, default = None):
     """
     Get the value of the keypath in the first catalog containing it.
     """
-    for name in cataloglist:
-        catalog = getCatalog(name)
-        if catalog is not None:
-            value = valueForKeyPath(catalog, keypath)
-            if value is not None:
-                return value
+    value = catalogIndex(cataloglist).lookup(keypath)
+    if value is None:
+        return default
+
+    return value
+
+
+CATALOG_INDEX_DEPTH = 2
+class CatalogIndex(object):
+    """
+    Merged view of a list of catalogs where the first catalog containing
+    a keypath wins. Keypaths up to CATALOG_INDEX_DEPTH keys long, such
+    as ManagedPrinters.<name>, are merged when the index is built. Longer
+    keypaths are looked up catalog by catalog on first use and then
+    remembered.
+    """
+
+    def __init__(self, catalogs, generation):
+        self.catalogs = catalogs
+        self.generation = generation
+        self.values = { }
+        self.deep = { }
+        self.lock = threading.Lock()
+        for catalog in catalogs:
+            if catalog is not None:
+                self.merge(catalog, '', 1)
+
+    def merge(self, dict, prefix, depth):
+        for key in dict:
+            #
+            # Keys containing a dot can never be reached by a keypath.
+            #
+            if not isinstance(key, basestring) or key.find('.') != -1:
+                continue
+            path = prefix + key
+            if path not in self.values:
+                self.values[path] = dict[key]
+            if depth < CATALOG_INDEX_DEPTH and hasattr(dict[key], 'keys'):
+                self.merge(dict[key], path + '.', depth + 1)
+
+    def lookup(self, keypath):
+        if keypath in self.values:
+            return self.values[keypath]
+        if keypath.count('.') < CATALOG_INDEX_DEPTH:
+            return None
 
-    return default
+        with self.lock:
+            if keypath not in self.deep:
+                value = None
+                for catalog in self.catalogs:
+                    if catalog is not None:
+                        value = valueForKeyPath(catalog, keypath)
+                        if value is not None:
+                            break
+                self.deep[keypath] = value
+            return self.deep[keypath]
+
+
+CATALOG_INDEXES = {}
+CATALOG_INDEXES_LOCK = threading.Lock()
+def catalogIndex(cataloglist):
+    """
+    Get the CatalogIndex for a list of catalog names. Indexes are cached
+    by the names and rebuilt when any catalog has been loaded since the
+    index was built.
+    """
+    key = tuple(cataloglist or [ ])
+    index = CATALOG_INDEXES.get(key)
+    if index is not None and index.generation == CATALOGS_GENERATION:
+        return index
+
+    #
+    # Loading a catalog here makes the index out of date right away,
+    # in which case it is built once more on the next call.
+    #
+    generation = CATALOGS_GENERATION
+    catalogs = [ getCatalog(name) for name in key ]
+    with CATALOG_INDEXES_LOCK:
+        index = CatalogIndex(catalogs, generation)
+        CATALOG_INDEXES[key] = index
+        return index
 
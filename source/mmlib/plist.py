@@ -0,0 +1,409 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Daniel Hazelbaker.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+plist.py
+"""
+import os
+import re
+import struct
+import datetime
+import tempfile
+import plistlib
+import binascii
+from xml.parsers import expat
+
+
+BINARY_MAGIC = 'bplist00'
+BINARY_EPOCH = datetime.datetime(2001, 1, 1)
+BINARY_TRAILER = struct.Struct('>6xBBQQQ')
+INT_FORMATS = { 1: '>B', 2: '>H', 4: '>L', 8: '>Q' }
+INT_SIZE_BITS = { 1: 0, 2: 1, 4: 2, 8: 3 }
+
+DATE_FORMAT = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})Z')
+
+
+class PlistError(ValueError):
+    pass
+
+
+def readPlist(path):
+    """
+    Read the XML or binary property list at path and return its top
+    level object. Dictionaries and arrays are returned as plain Python
+    dicts and lists, data as plistlib.Data and dates as datetime.
+    """
+    with open(path, 'rb') as fp:
+        data = fp.read()
+
+    return readPlistFromString(data)
+
+
+def readPlistFromString(data):
+    """
+    Parse an XML or binary property list held in a string.
+    """
+    if data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        return BinaryReader(data).parse()
+
+    return parseXML(data)
+
+
+def writePlist(value, path, binary = False):
+    """
+    Atomically write value to path as an XML or binary property list.
+    """
+    if binary:
+        data = BinaryWriter().write(value)
+    else:
+        data = plistlib.writePlistToString(value)
+
+    (fd, temp_path) = tempfile.mkstemp(dir = os.path.dirname(path) or '.', prefix = '.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        try: os.remove(temp_path)
+        except: pass
+        raise
+
+
+def plainString(value):
+    """
+    Use a plain str for ASCII text, as plistlib does.
+    """
+    try:
+        return value.encode('ascii')
+    except UnicodeError:
+        return value
+
+
+def parseXML(data):
+    """
+    XML property list parser built directly on expat. Each element is
+    turned into its value as soon as it ends, with containers kept on a
+    stack, so no intermediate tree is built. The handlers are closures
+    over local lists as expat calls them once per element.
+    """
+    stack = [ ]
+    keys = [ ]
+    text = [ ]
+    root = [ ]
+
+    def add(value):
+        if len(stack) == 0:
+            root.append(value)
+        elif type(stack[-1]) is dict:
+            if keys[-1] is None:
+                raise PlistError('Missing key for dictionary value')
+            stack[-1][keys[-1]] = value
+            keys[-1] = None
+        else:
+            stack[-1].append(value)
+
+    def startElement(name, attributes):
+        if name == 'dict':
+            stack.append({ })
+            keys.append(None)
+        elif name == 'array':
+            stack.append([ ])
+            keys.append(None)
+        del text[:]
+
+    def endElement(name):
+        if name == 'key':
+            keys[-1] = plainString(''.join(text))
+        elif name == 'string':
+            add(plainString(''.join(text)))
+        elif name == 'dict' or name == 'array':
+            keys.pop()
+            add(stack.pop())
+        elif name == 'integer':
+            add(int(''.join(text)))
+        elif name == 'true':
+            add(True)
+        elif name == 'false':
+            add(False)
+        elif name == 'real':
+            add(float(''.join(text)))
+        elif name == 'date':
+            add(parseDate(''.join(text)))
+        elif name == 'data':
+            add(plistlib.Data(binascii.a2b_base64(''.join(text))))
+
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = startElement
+    parser.EndElementHandler = endElement
+    parser.CharacterDataHandler = text.append
+    try:
+        parser.Parse(data, True)
+    except expat.ExpatError, e:
+        raise PlistError('Invalid property list: ' + str(e))
+
+    if len(root) == 0:
+        raise PlistError('Property list is empty')
+
+    return root[0]
+
+
+def parseDate(text):
+    match = DATE_FORMAT.match(text.strip())
+    if match is None:
+        raise PlistError('Invalid date: ' + text)
+
+    return datetime.datetime(*[ int(part) for part in match.groups() ])
+
+
+class BinaryReader(object):
+    """
+    Parser for the bplist00 binary property list format.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.objects = { }
+
+    def parse(self):
+        if len(self.data) < len(BINARY_MAGIC) + BINARY_TRAILER.size:
+            raise PlistError('Binary property list is truncated')
+
+        (offset_size, self.ref_size, count, top, table) = BINARY_TRAILER.unpack(self.data[-BINARY_TRAILER.size:])
+        if offset_size not in INT_FORMATS or self.ref_size not in INT_FORMATS:
+            raise PlistError('Invalid binary property list trailer')
+
+        try:
+            self.offsets = struct.unpack_from('>%d%s' % (count, INT_FORMATS[offset_size][1]), self.data, table)
+            return self.readObject(top)
+        except (struct.error, IndexError, UnicodeError), e:
+            raise PlistError('Invalid binary property list: ' + str(e))
+
+    def readInt(self, offset, size):
+        if size == 1:
+            return ord(self.data[offset])
+        if size == 2:
+            return struct.unpack('>H', self.data[offset:offset + 2])[0]
+        if size == 4:
+            return struct.unpack('>L', self.data[offset:offset + 4])[0]
+        if size == 8:
+            return struct.unpack('>q', self.data[offset:offset + 8])[0]
+        if size == 16:
+            (high, low) = struct.unpack('>qQ', self.data[offset:offset + 16])
+            return (high << 64) | low
+
+        value = 0
+        for c in self.data[offset:offset + size]:
+            value = (value << 8) | ord(c)
+        return value
+
+    def readLength(self, info, offset):
+        """
+        Get the length of an object and the offset of its contents.
+        Lengths of 15 or more follow the marker as an integer object.
+        """
+        if info != 0x0F:
+            return (info, offset + 1)
+
+        size = 1 << (ord(self.data[offset + 1]) & 0x0F)
+        return (self.readInt(offset + 2, size), offset + 2 + size)
+
+    def readRefs(self, offset, count):
+        return list(struct.unpack_from('>%d%s' % (count, INT_FORMATS[self.ref_size][1]), self.data, offset))
+
+    def readObject(self, ref):
+        if ref in self.objects:
+            return self.objects[ref]
+
+        offset = self.offsets[ref]
+        marker = ord(self.data[offset])
+        (kind, info) = (marker >> 4, marker & 0x0F)
+
+        if marker == 0x00:
+            value = None
+        elif marker == 0x08:
+            value = False
+        elif marker == 0x09:
+            value = True
+        elif kind == 0x1:
+            value = self.readInt(offset + 1, 1 << info)
+        elif kind == 0x2:
+            if info == 2:
+                value = struct.unpack('>f', self.data[offset + 1:offset + 5])[0]
+            else:
+                value = struct.unpack('>d', self.data[offset + 1:offset + 9])[0]
+        elif marker == 0x33:
+            seconds = struct.unpack('>d', self.data[offset + 1:offset + 9])[0]
+            value = BINARY_EPOCH + datetime.timedelta(seconds = seconds)
+        elif kind == 0x4:
+            (length, start) = self.readLength(info, offset)
+            value = plistlib.Data(self.data[start:start + length])
+        elif kind == 0x5:
+            (length, start) = self.readLength(info, offset)
+            value = self.data[start:start + length]
+        elif kind == 0x6:
+            (length, start) = self.readLength(info, offset)
+            value = plainString(self.data[start:start + length * 2].decode('utf-16-be'))
+        elif kind == 0x8:
+            value = self.readInt(offset + 1, info + 1)
+        elif kind == 0xA:
+            (length, start) = self.readLength(info, offset)
+            value = [ self.readObject(r) for r in self.readRefs(start, length) ]
+        elif kind == 0xD:
+            (length, start) = self.readLength(info, offset)
+            keys = self.readRefs(start, length)
+            values = self.readRefs(start + length * self.ref_size, length)
+            value = dict([ (self.readObject(keys[i]), self.readObject(values[i])) for i in range(length) ])
+        else:
+            raise PlistError('Unknown binary property list object 0x%02x' % marker)
+
+        #
+        # Only immutable values are shared between references, so that
+        # changing a returned container never changes another.
+        #
+        if not isinstance(value, (list, dict)):
+            self.objects[ref] = value
+
+        return value
+
+
+class BinaryWriter(object):
+    """
+    Writer for the bplist00 binary property list format. Equal strings
+    are stored once.
+    """
+
+    def __init__(self):
+        self.objects = [ ]
+        self.strings = { }
+
+    def write(self, value):
+        top = self.flatten(value)
+        self.ref_size = sizeFor(len(self.objects))
+
+        output = [ BINARY_MAGIC ]
+        position = len(BINARY_MAGIC)
+        offsets = [ ]
+        for obj in self.objects:
+            encoded = self.encode(obj)
+            offsets.append(position)
+            output.append(encoded)
+            position += len(encoded)
+
+        offset_size = sizeFor(position)
+        table = position
+        output.append(''.join([ packInt(offset, offset_size) for offset in offsets ]))
+        output.append(BINARY_TRAILER.pack(offset_size, self.ref_size, len(self.objects), top, table))
+
+        return ''.join(output)
+
+    def flatten(self, value):
+        """
+        Add value and everything it contains to the object list and
+        return the reference of value.
+        """
+        if isinstance(value, basestring):
+            key = (type(value), value)
+            if key in self.strings:
+                return self.strings[key]
+
+        ref = len(self.objects)
+        if isinstance(value, dict):
+            self.objects.append(None)
+            keys = sorted(value.keys())
+            refs = [ self.flatten(k) for k in keys ] + [ self.flatten(value[k]) for k in keys ]
+            self.objects[ref] = ('dict', refs)
+        elif isinstance(value, (list, tuple)):
+            self.objects.append(None)
+            self.objects[ref] = ('array', [ self.flatten(item) for item in value ])
+        else:
+            self.objects.append(value)
+            if isinstance(value, basestring):
+                self.strings[(type(value), value)] = ref
+
+        return ref
+
+    def encode(self, obj):
+        if isinstance(obj, tuple):
+            (kind, refs) = obj
+            refdata = ''.join([ packInt(r, self.ref_size) for r in refs ])
+            if kind == 'dict':
+                return lengthMarker(0xD, len(refs) / 2) + refdata
+            return lengthMarker(0xA, len(refs)) + refdata
+
+        if obj is None:
+            return '\x00'
+        if obj is False:
+            return '\x08'
+        if obj is True:
+            return '\x09'
+        if isinstance(obj, (int, long)):
+            if obj < 0:
+                return '\x13' + struct.pack('>q', obj)
+            if obj >= 1 << 63:
+                return '\x14' + packInt(obj >> 64, 8) + packInt(obj & 0xFFFFFFFFFFFFFFFF, 8)
+            size = sizeFor(obj + 1)
+            return chr(0x10 | INT_SIZE_BITS[size]) + packInt(obj, size)
+        if isinstance(obj, float):
+            return '\x23' + struct.pack('>d', obj)
+        if isinstance(obj, datetime.datetime):
+            delta = obj - BINARY_EPOCH
+            seconds = delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+            return '\x33' + struct.pack('>d', seconds)
+        if isinstance(obj, plistlib.Data):
+            return lengthMarker(0x4, len(obj.data)) + obj.data
+        if isinstance(obj, str):
+            try:
+                obj.decode('ascii')
+                return lengthMarker(0x5, len(obj)) + obj
+            except UnicodeError:
+                obj = obj.decode('utf-8')
+        if isinstance(obj, unicode):
+            try:
+                encoded = obj.encode('ascii')
+                return lengthMarker(0x5, len(encoded)) + encoded
+            except UnicodeError:
+                encoded = obj.encode('utf-16-be')
+                return lengthMarker(0x6, len(encoded) / 2) + encoded
+
+        raise PlistError('Cannot write ' + type(obj).__name__ + ' to a property list')
+
+
+def sizeFor(value):
+    """
+    Get the number of bytes needed to store values below value.
+    """
+    if value <= 0x100:
+        return 1
+    if value <= 0x10000:
+        return 2
+    if value <= 0x100000000:
+        return 4
+    if value <= 0x10000000000000000:
+        return 8
+    return 16
+
+
+def packInt(value, size):
+    return struct.pack(INT_FORMATS[size], value)
+
+
+def lengthMarker(kind, length):
+    if length < 0x0F:
+        return chr((kind << 4) | length)
+
+    size = sizeFor(length + 1)
+    return chr((kind << 4) | 0x0F) + chr(0x10 | INT_SIZE_BITS[size]) + packInt(length, size)
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Daniel Hazelbaker.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+ppdcache.py
+"""
+import os
+import time
+import hashlib
+import tempfile
+import threading
+
+from mmlib import mmcommon
+from mmlib import metrics
+
+
+PPD_CACHE_INDEX_PLIST = mmcommon.MANAGED_MAC_PPDCACHEDIR + "/index.plist"
+
+INDEX = mmcommon.PlistStore(PPD_CACHE_INDEX_PLIST)
+LOCK = INDEX.lock
+STATS = { 'Hits': 0, 'Misses': 0 }
+
+
+def fetch(url, checksum = None):
+    """
+    Get a local copy of the PPD at url. PPDs are stored in the cache by
+    content hash and revalidated with the server using the same
+    conditional GET validators as manifests and catalogs, so a PPD that
+    has not changed is never downloaded twice. Returns the path to the
+    cached PPD. If the server cannot be reached then the cached copy is
+    used, as long as it matches checksum. Otherwise, or if the download
+    fails its checksum or size checks, an exception is raised.
+    """
+    with LOCK:
+        index = loadIndex()
+        digest = index['URLs'].get(url)
+        cached_path = None
+        if digest is not None and os.path.exists(blobPath(digest)):
+            cached_path = blobPath(digest)
+
+    (fd, incoming_path) = tempfile.mkstemp(dir = mmcommon.MANAGED_MAC_PPDCACHEDIR, prefix = '.incoming.')
+    os.close(fd)
+    try:
+        try:
+            changed = mmcommon.downloadIfModified(url, incoming_path, checksum, None, cached_path)
+        except (mmcommon.ChecksumError, mmcommon.DownloadSizeError):
+            raise
+        except Exception, e:
+            if cached_path is None:
+                raise
+            if checksum is not None and not mmcommon.fileMatchesChecksum(cached_path, checksum):
+                raise
+            mmcommon.log('Could not revalidate PPD, using cached copy: ' + str(e))
+            changed = False
+
+        with LOCK:
+            if changed == False:
+                STATS['Hits'] += 1
+                metrics.increment('PPDCacheHits')
+                touch(digest)
+                evict(digest)
+                return cached_path
+
+            STATS['Misses'] += 1
+            metrics.increment('PPDCacheMisses')
+            digest = fileDigest(incoming_path)
+            path = blobPath(digest)
+            if os.path.exists(path):
+                os.remove(incoming_path)
+            else:
+                os.rename(incoming_path, path)
+            mmcommon.relocateValidators(url, path)
+
+            index['URLs'][url] = digest
+            touch(digest)
+            evict(digest)
+
+            return path
+    finally:
+        if os.path.exists(incoming_path):
+            os.remove(incoming_path)
+
+
+def blobPath(digest):
+    """
+    Get the path of the cached PPD with the given content hash.
+    """
+    return mmcommon.MANAGED_MAC_PPDCACHEDIR + '/' + digest + '.ppd'
+
+
+def fileDigest(path):
+    """
+    Calculate the SHA-256 content hash of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(mmcommon.DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def touch(digest):
+    """
+    Mark the cached PPD as just used.
+    """
+    path = blobPath(digest)
+    loadIndex()['Entries'][digest] = {
+        'Size': os.path.getsize(path),
+        'LastAccess': int(time.time()),
+    }
+    INDEX.markDirty()
+
+
+def evict(keep = None):
+    """
+    Remove the least recently used PPDs until the cache is within the
+    PPDCacheSize preference. The PPD identified by keep is never removed.
+    """
+    limit = mmcommon.pref('PPDCacheSize')
+    index = loadIndex()
+    entries = index['Entries']
+
+    total = sum([ entries[d]['Size'] for d in entries ])
+    for digest in sorted(entries.keys(), key = lambda d: entries[d]['LastAccess']):
+        if total <= limit:
+            break
+        if digest == keep:
+            continue
+
+        total -= entries[digest]['Size']
+        del entries[digest]
+        try:
+            os.remove(blobPath(digest))
+        except OSError:
+            pass
+        for url in [ u for u in index['URLs'] if index['URLs'][u] == digest ]:
+            del index['URLs'][url]
+        INDEX.markDirty()
+        mmcommon.log('Evicted PPD ' + digest + ' from the cache')
+
+
+def loadIndex():
+    """
+    Load the cache index. The index maps each URL to the content hash of
+    its PPD and records the size and last access time of each cached PPD.
+    """
+    with LOCK:
+        index = INDEX.load()
+        if 'URLs' not in index or 'Entries' not in index:
+            index.setdefault('URLs', { })
+            index.setdefault('Entries', { })
+            INDEX.markDirty()
+
+        #
+        # Forget cached PPDs that have been removed from disk.
+        #
+        for digest in index['Entries'].keys():
+            if not os.path.exists(blobPath(digest)):
+                del index['Entries'][digest]
+                INDEX.markDirty()
+
+    return index
+
+
+def summary():
+    """
+    Return a single line description of the cache hit/miss counters.
+    """
+    return '%d hits, %d misses' % (STATS['Hits'], STATS['Misses'])
@@ -19,35 +19,37 @@ printers.py
 import os
 import subprocess
 import re
+import threading
+import time
+
+from mmlib import ipp
+from mmlib import metrics
+from mmlib import mmcommon
+
+
+PPD_INFO_PLIST = mmcommon.MANAGED_MAC_DIR + "/PPDInfo.plist"
+PPD_INFO = mmcommon.PlistStore(PPD_INFO_PLIST)
+
+PPD_INFO_KEYS = [ 'Manufacturer', 'ModelName', 'NickName' ]
+PPD_INFO_PATTERN = re.compile('\*(Manufacturer|ModelName|NickName):[ \t]*\"(.*)\"')
 
 
 def ppdInfo(filename):
     """
     Get information from the printer's installed PPD file. All keys will
-    be set to blank strings if they could not be found in the PPD.
+    be set to blank strings if they could not be found in the PPD. The
+    result is remembered by the modification time and size of the PPD
+    so an unchanged PPD is only read once.
     """
-    textfile = open(filename, 'r')
-    filetext = textfile.read()
-    textfile.close()
-
-    info = { }
-    matches = re.findall('\*Manufacturer:[ \t]*\"(.*)\"', filetext)
-    if len(matches) > 0:
-        info['Manufacturer'] = matches[0]
-    else:
-        info['Manufacturer'] = ''
-
-    matches = re.findall('\*ModelName:[ \t]*\"(.*)\"', filetext)
-    if len(matches) > 0:
-        info['ModelName'] = matches[0]
-    else:
-        info['ModelName'] = ''
+    statinfo = os.stat(filename)
+    with PPD_INFO.lock:
+        entry = PPD_INFO.get(filename)
+        if entry is not None and entry.get('MTime') == statinfo.st_mtime and entry.get('Size') == statinfo.st_size:
+            metrics.increment('PPDInfoHits')
+            return dict(entry['Info'])
 
-    matches = re.findall('\*NickName:[ \t]*\"(.*)\"', filetext)
-    if len(matches) > 0:
-        info['NickName'] = matches[0]
-    else:
-        info['NickName'] = ''
+    metrics.increment('PPDInfoMisses')
+    info = scanPPD(filename)
 
     #
     # Update the Model and NickName to include the Manufacturer
@@ -59,95 +61,296 @@ def ppdInfo(filename):
         if info['NickName'].find(info['Manufacturer']) != 0:
             info['NickName'] = info['Manufacturer'] + " " + info['NickName']
 
+    with PPD_INFO.lock:
+        entries = PPD_INFO.load()
+        for path in [ path for path in entries if path != filename and not os.path.exists(path) ]:
+            del entries[path]
+        entries[filename] = { 'MTime': statinfo.st_mtime, 'Size': statinfo.st_size, 'Info': dict(info) }
+        PPD_INFO.markDirty()
+
     return info
 
 
-def add(printer_name, uri, ppd, location, description):
+def scanPPD(filename):
     """
-    Add a new printer to the system with the given parameters.
+    Read the first Manufacturer, ModelName and NickName from a PPD file,
+    which may be gzip compressed. The file is read a line at a time and
+    only until all three have been found, they are normally near the top.
     """
+    with open(filename, 'rb') as fp:
+        compressed = (fp.read(2) == '\x1f\x8b')
+
+    if compressed:
+        import gzip
+        ppdfile = gzip.open(filename, 'rb')
+    else:
+        ppdfile = open(filename, 'rU')
+
+    info = { }
     try:
-        if ppd[:4] == 'drv:':
-            type = '-m'
+        for line in ppdfile:
+            if not line.startswith('*'):
+                continue
+            match = PPD_INFO_PATTERN.match(line)
+            if match is not None and match.group(1) not in info:
+                info[match.group(1)] = match.group(2)
+                if len(info) == len(PPD_INFO_KEYS):
+                    break
+    finally:
+        ppdfile.close()
+
+    for key in PPD_INFO_KEYS:
+        info.setdefault(key, '')
+
+    return info
+
+
+class SubprocessBackend(object):
+    """
+    Printer backend that runs the CUPS command line tools.
+    """
+
+    def snapshot(self):
+        """
+        Return the state of every printer as parsed from lpstat.
+        """
+        return parseLpstat(lpstatAll())
+
+    def add(self, printer_name, uri, ppd, location, description):
+        """
+        Add a new printer to the system with the given parameters.
+        """
+        try:
+            if ppd[:4] == 'drv:':
+                type = '-m'
+            else:
+                type = '-P'
+
+            with open(os.devnull, "w") as fnull:
+                args = ["lpadmin", "-p", printer_name, "-v", uri, type, ppd, "-D", description, "-L", location, "-E"]
+                status = subprocess.call(args, stdout=fnull, stderr=subprocess.STDOUT)
+        except:
+            return False
+
+        return True if status == 0 else False
+
+    def delete(self, printer_name):
+        """
+        Delete the given named printer from the system.
+        """
+        try:
+            with open(os.devnull, 'w') as fnull:
+                status = subprocess.call(['/usr/sbin/lpadmin', '-x', printer_name], stdout=fnull, stderr=subprocess.STDOUT)
+        except:
+            return False
+
+        return True if status == 0 else False
+
+    def exists(self, printer_name):
+        """
+        Check if the named printer exists.
+        """
+        try:
+            with open(os.devnull, 'w') as fnull:
+                status = subprocess.call(['/usr/bin/lpstat', '-a', printer_name], stdout=fnull, stderr=subprocess.STDOUT)
+        except:
+            return False
+
+        return True if status == 0 else False
+
+    def setOptions(self, printer_name, options):
+        """
+        Set the default options of the named printer.
+        """
+        try:
+            args = [ '/usr/sbin/lpadmin', '-p', printer_name ]
+            for key in options:
+                args += [ '-o', key + "=" + options[key] ]
+            with open(os.devnull, 'w') as fnull:
+                status = subprocess.call(args, stdout=fnull, stderr=subprocess.STDOUT)
+        except Exception, e:
+            print str(e)
+            return False
+
+        return True if status == 0 else False
+
+    def acceptJobs(self, printer_name):
+        """
+        Tell the CUPS system to start accepting jobs for the named printer.
+        """
+        try:
+            with open(os.devnull, 'w') as fnull:
+                status = subprocess.call(['/usr/sbin/cupsaccept', printer_name], stdout=fnull, stderr=subprocess.STDOUT)
+        except:
+            return False
+
+        return True if status == 0 else False
+
+    def rejectJobs(self, printer_name):
+        """
+        Tell the CUPS system to stop accepting jobs for the named printer.
+        """
+        try:
+            with open(os.devnull, 'w') as fnull:
+                status = subprocess.call(['/usr/sbin/cupsreject', printer_name], stdout=fnull, stderr=subprocess.STDOUT)
+        except:
+            return False
+
+        return True if status == 0 else False
+
+    def jobCount(self, printer_name):
+        """
+        Retrieve the number of jobs in the named printer's queue.
+        """
+        try:
+            value = subprocess.check_output(['/usr/bin/lpstat', '-o', printer_name], stderr=subprocess.STDOUT)
+        except:
+            return -1
+
+        return (len(value.split("\n")) - 1)
+
+    def status(self, printer_name):
+        """
+        Retrieve the status of the printer. Returns one of the following strings:
+        idle, printing, paused, unknown
+        """
+        try:
+            value = subprocess.check_output(['/usr/bin/lpstat', '-p', printer_name], stderr=subprocess.STDOUT)
+        except:
+            return 0
+
+        if value.find(' is idle.') != -1:
+            return 'idle'
+        elif value.find(' now printing ') != -1:
+            return 'printing'
+        elif value.find(' disabled since ') != -1:
+            return 'paused'
         else:
-            type = '-P'
+            return 'unknown'
 
-        with open(os.devnull, "w") as fnull:
-            args = ["lpadmin", "-p", printer_name, "-v", uri, type, ppd, "-D", description, "-L", location, "-E"]
-            status = subprocess.call(args, stdout=fnull, stderr=subprocess.STDOUT)
-    except:
-        return False
+    def uri(self, printer_name):
+        """
+        Retrieve the current URI for the named printer.
+        """
+        try:
+            value = subprocess.check_output(['/usr/bin/lpstat', '-v', printer_name], stderr=subprocess.STDOUT)
+        except:
+            return 0
 
-    return True if status == 0 else False
+        matches = re.findall('[^:]*:[ \t]+(.*)', value)
+        if len(matches) > 0:
+            return matches[0]
 
+        return ""
 
-def delete(printer_name):
+
+BACKENDS = {
+    'subprocess': SubprocessBackend,
+    'ipp': ipp.IPPBackend,
+}
+BACKEND = None
+FALLBACK = SubprocessBackend()
+
+
+def setBackend(name):
     """
-    Delete the given named printer from the system.
+    Select the backend used to talk to CUPS, either 'ipp' or 'subprocess'.
+    The subprocess backend is always used as a fallback if the IPP
+    backend cannot complete a request.
     """
-    try:
-        with open(os.devnull, 'w') as fnull:
-            status = subprocess.call(['/usr/sbin/lpadmin', '-x', printer_name], stdout=fnull, stderr=subprocess.STDOUT)
-    except:
-        return False
+    global BACKEND
 
-    return True if status == 0 else False
+    if name not in BACKENDS:
+        raise ValueError('Unknown printer backend: ' + str(name))
+    BACKEND = BACKENDS[name]()
 
 
-def exists(printer_name):
+#
+# Backend methods that do not change anything and so can always be
+# made again with the subprocess backend.
+#
+READ_ONLY_METHODS = [ 'snapshot', 'exists', 'uri', 'status', 'jobCount' ]
+
+
+def callBackend(method, *args):
     """
-    Check if the named printer exists.
+    Call the named method on the current backend. If the backend fails
+    on a query, or on a change that never reached cupsd, then the call
+    is made again with the subprocess backend. A change that may have
+    been partly applied is not repeated, False is returned instead. If
+    cupsd cannot be reached at all, the subprocess backend is used for
+    the rest of the run.
     """
+    global BACKEND
+
+    backend = BACKEND or FALLBACK
+    if backend is FALLBACK:
+        return getattr(FALLBACK, method)(*args)
+
     try:
-        with open(os.devnull, 'w') as fnull:
-            status = subprocess.call(['/usr/bin/lpstat', '-a', printer_name], stdout=fnull, stderr=subprocess.STDOUT)
-    except:
-        return False
+        return getattr(backend, method)(*args)
+    except ipp.IPPError, e:
+        mmcommon.log('IPP ' + method + ' failed: ' + str(e))
+        if e.status is None and not e.delivered:
+            if isinstance(e, ipp.IPPConnectionError):
+                BACKEND = FALLBACK
+        elif method not in READ_ONLY_METHODS:
+            return False
+    except Exception, e:
+        mmcommon.log('IPP ' + method + ' failed: ' + str(e))
+        if method not in READ_ONLY_METHODS:
+            return False
 
-    return True if status == 0 else False
+    return getattr(FALLBACK, method)(*args)
 
 
-def setOptions(printer_name, options):
+def snapshotState():
+    """
+    Return the state of every printer, see parseLpstat().
+    """
+    return callBackend('snapshot')
+
+
+def add(printer_name, uri, ppd, location, description):
+    """
+    Add a new printer to the system with the given parameters.
+    """
+    return callBackend('add', printer_name, uri, ppd, location, description)
+
+
+def delete(printer_name):
+    """
+    Delete the given named printer from the system.
+    """
+    return callBackend('delete', printer_name)
+
+
+def exists(printer_name):
     """
     Check if the named printer exists.
     """
-    try:
-        args = [ '/usr/sbin/lpadmin', '-p', printer_name ]
-        for key in options:
-            args += [ '-o', key + "=" + options[key] ]
-        with open(os.devnull, 'w') as fnull:
-            status = subprocess.call(args, stdout=fnull, stderr=subprocess.STDOUT)
-    except Exception, e:
-        print str(e)
-        return False
+    return callBackend('exists', printer_name)
 
-    return True if status == 0 else False
+
+def setOptions(printer_name, options):
+    """
+    Set the default options of the named printer.
+    """
+    return callBackend('setOptions', printer_name, options)
 
 
 def acceptJobs(printer_name):
     """
     Tell the CUPS system to start accepting jobs for the named printer.
     """
-    try:
-        with open(os.devnull, 'w') as fnull:
-            status = subprocess.call(['/usr/sbin/cupsaccept', printer_name], stdout=fnull, stderr=subprocess.STDOUT)
-    except:
-        return False
-
-    return True if status == 0 else False
+    return callBackend('acceptJobs', printer_name)
 
 
 def rejectJobs(printer_name):
     """
     Tell the CUPS system to stop accepting jobs for the named printer.
     """
-    try:
-        with open(os.devnull, 'w') as fnull:
-            status = subprocess.call(['/usr/sbin/cupsreject', printer_name], stdout=fnull, stderr=subprocess.STDOUT)
-    except:
-        return False
-
-    return True if status == 0 else False
+    return callBackend('rejectJobs', printer_name)
 
 
 def hasJobs(printer_name):
@@ -161,12 +364,7 @@ def jobCount(printer_name):
     """
     Retrieve the number of jobs in the named printer's queue.
     """
-    try:
-        value = subprocess.check_output(['/usr/bin/lpstat', '-o', printer_name], stderr=subprocess.STDOUT)
-    except:
-        return -1
-
-    return (len(value.split("\n")) - 1)
+    return callBackend('jobCount', printer_name)
 
 
 def status(printer_name):
@@ -174,40 +372,161 @@ def status(printer_name):
     Retrieve the status of the printer. Returns one of the following strings:
     idle, printing, paused, unknown
     """
-    try:
-        value = subprocess.check_output(['/usr/bin/lpstat', '-p', printer_name], stderr=subprocess.STDOUT)
-    except:
-        return 0
-
-    if value.find(' is idle.') != -1:
-        return 'idle'
-    elif value.find(' now printing ') != -1:
-        return 'printing'
-    elif value.find(' disabled since ') != -1:
-        return 'paused'
-    else:
-        return 'unknown'
+    return callBackend('status', printer_name)
 
 
 def isPrinting(printer_name):
     """
     Tests wether the named printer is currently printing a document.
     """
-    return True if printerStatus(printer_name) == 'printing' else False
+    return True if status(printer_name) == 'printing' else False
 
 
 def uri(printer_name):
     """
     Retrieve the current URI for the named printer.
     """
+    return callBackend('uri', printer_name)
+
+
+def lpstatAll():
+    """
+    Run a single lpstat query for every printer's device URI, accepting
+    state, status and queued jobs. Returns the raw output.
+    """
+    env = dict(os.environ)
+    env['LC_ALL'] = 'C'
     try:
-        value = subprocess.check_output(['/usr/bin/lpstat', '-v', printer_name], stderr=subprocess.STDOUT)
+        with open(os.devnull, 'w') as fnull:
+            proc = subprocess.Popen(['/usr/bin/lpstat', '-v', '-a', '-p', '-o'], stdout=subprocess.PIPE, stderr=fnull, env=env)
+            return proc.communicate()[0]
     except:
-        return 0
+        return ''
 
-    matches = re.findall('[^:]*:[ \t]+(.*)', value)
-    if len(matches) > 0:
-        return matches[0]
 
-    return ""
+class CupsSnapshot(object):
+    """
+    In-memory index of the CUPS printer state built from one bulk query
+    through the printer backend. The index is loaded on first use and
+    reloaded on the next query after invalidate() is called, which should
+    be done after any change is made to the printers. A different lpstat
+    function can be passed in to provide canned lpstat output.
+    """
 
+    def __init__(self, lpstat = None):
+        self.lpstat = lpstat
+        self.lock = threading.RLock()
+        self.printers = None
+        self.loaded = None
+
+    def refresh(self):
+        """
+        Reload the printer state from CUPS.
+        """
+        if self.lpstat is not None:
+            printers = parseLpstat(self.lpstat())
+        else:
+            printers = snapshotState()
+        with self.lock:
+            self.printers = printers
+            self.loaded = time.time()
+
+    def age(self):
+        """
+        Get the number of seconds since the index was loaded, or None if
+        it is not loaded.
+        """
+        with self.lock:
+            if self.printers is None:
+                return None
+            return time.time() - self.loaded
+
+    def invalidate(self):
+        """
+        Mark the index as out of date so it is reloaded on next use.
+        """
+        with self.lock:
+            self.printers = None
+
+    def printer(self, printer_name):
+        """
+        Get the index entry for the named printer, or None if it does
+        not exist.
+        """
+        with self.lock:
+            if self.printers is None:
+                self.refresh()
+            return self.printers.get(printer_name)
+
+    def printerNames(self):
+        with self.lock:
+            if self.printers is None:
+                self.refresh()
+            return sorted(self.printers.keys())
+
+    def exists(self, printer_name):
+        return self.printer(printer_name) is not None
+
+    def uri(self, printer_name):
+        printer = self.printer(printer_name)
+        return printer['uri'] if printer is not None else ''
+
+    def status(self, printer_name):
+        printer = self.printer(printer_name)
+        return printer['status'] if printer is not None else 'unknown'
+
+    def isAccepting(self, printer_name):
+        printer = self.printer(printer_name)
+        return printer['accepting'] if printer is not None else False
+
+    def jobCount(self, printer_name):
+        printer = self.printer(printer_name)
+        return printer['jobs'] if printer is not None else -1
+
+    def hasJobs(self, printer_name):
+        return True if self.jobCount(printer_name) > 0 else False
+
+
+def parseLpstat(output):
+    """
+    Parse the output of lpstat -v -a -p -o into a dictionary of printer
+    name to its uri, accepting state, status and number of queued jobs.
+    """
+    printers = { }
+
+    def entry(name):
+        if name not in printers:
+            printers[name] = { 'uri': '', 'accepting': False, 'status': 'unknown', 'jobs': 0 }
+        return printers[name]
+
+    for line in output.split('\n'):
+        if line == '' or line[0] in ' \t':
+            continue
+
+        match = re.match('device for (\S+):[ \t]+(.*)$', line)
+        if match:
+            entry(match.group(1))['uri'] = match.group(2)
+            continue
+
+        match = re.match('(\S+) (not )?accepting requests', line)
+        if match:
+            entry(match.group(1))['accepting'] = match.group(2) is None
+            continue
+
+        match = re.match('printer (\S+) ', line)
+        if match:
+            if line.find(' is idle.') != -1:
+                entry(match.group(1))['status'] = 'idle'
+            elif line.find(' now printing ') != -1:
+                entry(match.group(1))['status'] = 'printing'
+            elif line.find(' disabled since ') != -1:
+                entry(match.group(1))['status'] = 'paused'
+            else:
+                entry(match.group(1))['status'] = 'unknown'
+            continue
+
+        match = re.match('(\S+)-\d+[ \t]', line)
+        if match:
+            entry(match.group(1))['jobs'] += 1
+
+    return printers
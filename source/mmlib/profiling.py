@@ -0,0 +1,134 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Daniel Hazelbaker.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+profiling.py
+"""
+import os
+import re
+import sys
+import time
+import cProfile
+import pstats
+
+from mmlib import mmcommon
+
+
+PROFILE_DIR = mmcommon.MANAGED_MAC_LOGDIR + "/Profiles"
+PROFILE_TOP = 25
+
+#
+# Groups of calls whose time is totalled in the summary. Each entry is
+# the name of the group and the module files and function names that
+# belong to it. An empty function list matches every function in the
+# module.
+#
+CATEGORIES = [
+    ('subprocess', [ ('subprocess.py', [ ]),
+        ('metrics.py', [ '__init__', 'wait', 'communicate', 'metricsDone' ]) ]),
+    ('urllib', [ ('urllib.py', [ ]), ('urllib2.py', [ ]), ('httplib.py', [ ]),
+        ('socket.py', [ ]), ('ssl.py', [ ]) ]),
+    ('plist', [ ('plistlib.py', [ ]), ('plist.py', [ ]),
+        ('mmcommon.py', [ 'readDictionary', 'writeDictionary' ]) ]),
+]
+
+
+class Profiler(object):
+    """
+    Runs functions under cProfile, writing one .pstats file per call
+    into a new directory below PROFILE_DIR.
+    """
+
+    def __init__(self, directory = None):
+        if directory is None:
+            directory = PROFILE_DIR + '/' + time.strftime('%Y-%m-%d_%H%M%S')
+        self.directory = directory
+        self.profiles = [ ]
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def call(self, name, func, *args, **kwargs):
+        """
+        Call func under the profiler and save the statistics as
+        name.pstats. Exceptions raised by func are passed on once the
+        statistics have been saved.
+        """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            path = self.directory + '/' + re.sub(r'[^A-Za-z0-9_.-]', '_', name) + '.pstats'
+            try:
+                profile.dump_stats(path)
+                self.profiles.append((name, path))
+            except Exception, e:
+                mmcommon.log('Could not save profile ' + path + ': ' + str(e))
+
+    def summary(self, top = PROFILE_TOP, stream = None):
+        """
+        Print the time spent in each category for every profiled call,
+        followed by the top functions of all calls combined sorted by
+        cumulative time.
+        """
+        if stream is None:
+            stream = sys.stdout
+        if len(self.profiles) == 0:
+            return
+
+        print >> stream, 'Profiles saved to ' + self.directory
+        names = [ name for (name, categories) in CATEGORIES ]
+        print >> stream, '%-30s %10s' % ('Profile', 'total') + ''.join([ ' %10s' % n for n in names ])
+        for (name, path) in self.profiles:
+            stats = pstats.Stats(path)
+            times = categoryTimes(stats)
+            print >> stream, '%-30s %10.3f' % (name, stats.total_tt) + ''.join([ ' %10.3f' % times[n] for n in names ])
+
+        combined = pstats.Stats(*[ path for (name, path) in self.profiles ], stream = stream)
+        combined.strip_dirs().sort_stats('cumulative').print_stats(top)
+
+
+def categoryTimes(stats):
+    """
+    Total the cumulative time spent in each category. Only calls made
+    from outside the category are counted so that nested calls within
+    a category are not counted twice.
+    """
+    times = { }
+    for (name, modules) in CATEGORIES:
+        times[name] = 0.0
+        for key in stats.stats:
+            if not inCategory(key, modules):
+                continue
+            callers = stats.stats[key][4]
+            for caller in callers:
+                if not inCategory(caller, modules):
+                    times[name] += callers[caller][3]
+
+    return times
+
+
+def inCategory(key, modules):
+    """
+    Check if the function identified by the pstats key belongs to one of
+    the modules of a category.
+    """
+    (filename, line, function) = key
+    for (module, functions) in modules:
+        if os.path.basename(filename) == module:
+            if len(functions) == 0 or function in functions:
+                return True
+
+    return False
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Daniel Hazelbaker.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+runner.py
+"""
+import threading
+
+from mmlib import mmcommon
+
+
+class Action(object):
+    """
+    An action plugin and the scheduling information it declares. A
+    plugin may define DEPENDS, a list of the names of other actions
+    (without the .py) that must finish before it starts, and LOCKS, a
+    list of shared resources such as 'cups' or 'network' that only one
+    action may use at a time.
+    """
+
+    def __init__(self, filename, module):
+        self.filename = filename
+        self.name = filename[:-3] if filename.endswith('.py') else filename
+        self.module = module
+        self.depends = list(getattr(module, 'DEPENDS', [ ]))
+        self.locks = list(getattr(module, 'LOCKS', [ ]))
+
+
+def runActions(actions, func, workers = None):
+    """
+    Call func(action) for each action, running independent actions in
+    parallel. An action starts once all of its dependencies have
+    finished and none of its locks are held by a running action.
+    Dependencies on actions that are not in the list are ignored.
+    Returns a dictionary of action name to the value returned by func.
+    With a single worker the actions are run one at a time in the
+    calling thread.
+    """
+    if workers is None:
+        workers = mmcommon.pref('ActionWorkers')
+    workers = max(1, int(workers))
+
+    names = [ action.name for action in actions ]
+    for action in actions:
+        for name in action.depends:
+            if name not in names:
+                mmcommon.log('Action ' + action.name + ' depends on unknown action ' + name + ', ignoring.')
+        action.depends = [ name for name in action.depends if name in names ]
+
+    pending = list(actions)
+    results = { }
+    held = set()
+    running = [ ]
+    condition = threading.Condition()
+
+    def ready(action):
+        for name in action.depends:
+            if name not in results:
+                return False
+        for lock in action.locks:
+            if lock in held:
+                return False
+        return True
+
+    def execute(action):
+        try:
+            result = func(action)
+        except Exception, e:
+            mmcommon.log('Action ' + action.name + ' failed: ' + str(e))
+            result = None
+
+        with condition:
+            results[action.name] = result
+            held.difference_update(action.locks)
+            if action in running:
+                running.remove(action)
+            condition.notifyAll()
+
+    with condition:
+        while len(pending) > 0:
+            startable = [ action for action in pending if ready(action) ]
+
+            #
+            # Nothing can start and nothing is running to finish, so the
+            # remaining actions depend on each other. Break the cycle by
+            # starting the first of them anyway.
+            #
+            if len(startable) == 0 and len(running) == 0:
+                action = pending[0]
+                mmcommon.log('Dependency cycle detected, running ' + action.name + ' without waiting for ' + ', '.join(action.depends))
+                action.depends = [ ]
+                continue
+
+            started = False
+            for action in startable:
+                if len(running) >= workers:
+                    break
+                if not ready(action):
+                    continue
+
+                pending.remove(action)
+                held.update(action.locks)
+                running.append(action)
+                started = True
+                if workers == 1:
+                    condition.release()
+                    try:
+                        execute(action)
+                    finally:
+                        condition.acquire()
+                    break
+                thread = threading.Thread(target = execute, args = (action, ))
+                thread.start()
+
+            if not started or len(running) >= workers:
+                condition.wait()
+
+        while len(running) > 0:
+            condition.wait()
+
+    return results
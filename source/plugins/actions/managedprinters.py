@@ -19,14 +19,32 @@ managedprinters.py
 import sys
 import time
 import os
+import json
+import hashlib
+import threading
 
 from mmlib import mmcommon
 from mmlib import printers
+from mmlib import ppdcache
+from mmlib import metrics
 
 
 MANAGED_PRINTERS_STATUS_PLIST = mmcommon.MANAGED_MAC_DIR + "/PrinterStatus.plist"
 MANAGED_PRINTERS_PLIST = mmcommon.MANAGED_MAC_DIR + "/ManagedPrinters.plist"
 MANAGED_PRINTERS_USERLIST_DIR = mmcommon.MANAGED_MAC_DIR + "/ManagedPrinters/UserPrinters"
+MANAGED_PRINTERS_RETRY_PLIST = mmcommon.MANAGED_MAC_DIR + "/PrinterRetry.plist"
+CUPS_PPD_DIR = "/etc/cups/ppd"
+
+CUPS = printers.CupsSnapshot()
+STATE_LOCK = threading.RLock()
+STATUS_STORE = mmcommon.PlistStore(MANAGED_PRINTERS_STATUS_PLIST)
+USER_STORE = mmcommon.PlistStore(MANAGED_PRINTERS_PLIST)
+DEFERRED = [ ]
+
+#
+# Only one action at a time may change the CUPS configuration.
+#
+LOCKS = [ 'cups' ]
 
 
 def run():
@@ -36,20 +54,182 @@ def run():
     installinfo = { }
     uninstallinfo = { }
 
+    prepareCups()
+
     # Process user selections (e.g. via munki)
     try:
         files = [f for f in os.listdir(MANAGED_PRINTERS_USERLIST_DIR) if os.path.isfile(os.path.join(MANAGED_PRINTERS_USERLIST_DIR, f))]
     except:
         files = []
+    tasks = [ ]
     for p in files:
-        mmcommon.processManualRun(None, installinfo, processUserInstall, p)
+        mmcommon.processManualRun(None, installinfo, deferTask(tasks, processUserInstall), p)
     for p in userPrinters():
         if p not in files:
-            mmcommon.processManualRun(None, uninstallinfo, processUserUninstall, p)
+            mmcommon.processManualRun(None, uninstallinfo, deferTask(tasks, processUserUninstall), p)
 
     # Process system mandated items
-    mmcommon.processManifestKeyPath(None, 'ManagedPrinters.Uninstall', uninstallinfo, processSystemUninstall)
-    mmcommon.processManifestKeyPath(None, 'ManagedPrinters.Install', installinfo, processSystemInstall)
+    mmcommon.processManifestKeyPath(None, 'ManagedPrinters.Uninstall', uninstallinfo, deferTask(tasks, processSystemUninstall))
+    mmcommon.processManifestKeyPath(None, 'ManagedPrinters.Install', installinfo, deferTask(tasks, processSystemInstall))
+
+    reconcile(tasks)
+    retryDeferred()
+
+    if ppdcache.STATS['Hits'] + ppdcache.STATS['Misses'] > 0:
+        mmcommon.log('PPD cache: ' + ppdcache.summary())
+
+
+def retry():
+    """
+    Retry only the printers that were still busy at the end of the last
+    run. This is called by the frequent retry run, which uses the cached
+    catalogs instead of downloading the manifests and catalogs again.
+    Returns True if there were printers to retry.
+    """
+    entries = loadRetryList()
+    if len(entries) == 0:
+        return False
+
+    #
+    # The busy printers are waiting on their queued jobs, which change
+    # without us, so the CUPS state is always reloaded.
+    #
+    prepareCups()
+    CUPS.invalidate()
+    mmcommon.log('Retrying ' + str(len(entries)) + ' busy printer(s).')
+    mmcommon.parallelMap(retryPrinter, entries, mmcommon.pref('PrinterWorkers'))
+    saveRetryList(DEFERRED)
+
+    return True
+
+
+def prepareCups():
+    """
+    Select the printer backend and get ready for a run.
+    """
+    global DEFERRED
+
+    try:
+        printers.setBackend(mmcommon.pref('PrinterBackend'))
+    except ValueError, e:
+        mmcommon.log(str(e) + ', using subprocess backend.')
+        printers.setBackend('subprocess')
+
+    #
+    # The daemon keeps the CUPS state between runs, it is reloaded after
+    # every change made here. Changes made outside managedmac are picked
+    # up once the state is older than PrinterVerifyInterval.
+    #
+    age = CUPS.age()
+    if age is not None and age >= mmcommon.pref('PrinterVerifyInterval'):
+        CUPS.invalidate()
+    DEFERRED = [ ]
+
+
+def deferTask(tasks, handler):
+    """
+    Wrap a handler so that calling it adds a task to the list instead
+    of processing the printer right away.
+    """
+    def defer(pname, cataloglist, runinfo):
+        tasks.append((pname, handler, cataloglist, runinfo))
+    return defer
+
+
+def reconcile(tasks):
+    """
+    Run the queued printer tasks in a bounded pool of worker threads.
+    All the tasks for one printer are run in order by the same worker,
+    so a printer's runinfo entry is only ever touched by one thread and
+    independent printers do not wait on each other.
+    """
+    groups = { }
+    order = [ ]
+    for task in tasks:
+        if task[0] not in groups:
+            groups[task[0]] = [ ]
+            order.append(task[0])
+        groups[task[0]].append(task)
+
+    mmcommon.parallelMap(lambda pname: reconcilePrinter(groups[pname]), order, mmcommon.pref('PrinterWorkers'))
+
+
+def reconcilePrinter(tasks):
+    """
+    Run the tasks for a single printer, tagging log messages with the
+    printer name.
+    """
+    mmcommon.setLogTag(tasks[0][0])
+    try:
+        for (pname, handler, cataloglist, runinfo) in tasks:
+            try:
+                handler(pname, cataloglist, runinfo)
+            except Exception, e:
+                mmcommon.log('Error processing printer ' + pname + ': ' + str(e))
+    finally:
+        mmcommon.setLogTag(None)
+
+
+def deferPrinter(pname, cataloglist, asuser, since = None):
+    """
+    Remember a printer that could not be updated because it was busy.
+    """
+    with STATE_LOCK:
+        DEFERRED.append({
+            'Name': pname,
+            'Catalogs': list(cataloglist or [ ]),
+            'AsUser': asuser,
+            'Since': since or int(time.time()),
+        })
+    metrics.increment('PrintersDeferred')
+
+
+def retryDeferred():
+    """
+    Give the printers that were busy earlier in this run one more try
+    now that the other printers are done. Any that are still busy are
+    saved to the retry list.
+    """
+    global DEFERRED
+
+    entries = DEFERRED
+    DEFERRED = [ ]
+    if len(entries) > 0:
+        CUPS.invalidate()
+        mmcommon.parallelMap(retryPrinter, entries, mmcommon.pref('PrinterWorkers'))
+    saveRetryList(DEFERRED)
+
+
+def retryPrinter(entry):
+    """
+    Try to install a previously deferred printer again.
+    """
+    mmcommon.setLogTag(entry['Name'])
+    try:
+        processInstall(entry['Name'], entry['Catalogs'] or None, entry['AsUser'], { }, entry['Since'])
+    finally:
+        mmcommon.setLogTag(None)
+
+
+def loadRetryList():
+    with STATE_LOCK:
+        data = mmcommon.readDictionary(MANAGED_PRINTERS_RETRY_PLIST)
+    if data is None or 'Printers' not in data:
+        return [ ]
+
+    return [ dict(entry) for entry in data['Printers'] ]
+
+
+def saveRetryList(entries):
+    """
+    Save the printers that are still busy, or remove the retry list if
+    there are none left.
+    """
+    with STATE_LOCK:
+        if len(entries) > 0:
+            mmcommon.writeDictionary({ 'Printers': entries }, MANAGED_PRINTERS_RETRY_PLIST, True)
+        elif os.path.exists(MANAGED_PRINTERS_RETRY_PLIST):
+            os.remove(MANAGED_PRINTERS_RETRY_PLIST)
 
 
 def processUserUninstall(pname, cataloglist, runinfo):
@@ -66,11 +246,14 @@ def processUninstall(pname, cataloglist, asuser, runinfo):
     from the system.
     """
     try:
-        if printers.exists(pname):
+        if CUPS.exists(pname):
             mmcommon.log('Printer ' + pname + ' has been marked for uninstall.')
-            if printers.delete(pname) == False:
+            deleted = printers.delete(pname)
+            CUPS.invalidate()
+            if deleted == False:
                 raise RuntimeWarning('Unknown error trying to delete printer');
             mmcommon.log('Printer ' + pname + ' removed.')
+            metrics.increment('PrintersRemoved')
             if asuser:
                 removedUserPrinter(pname);
     except Exception, e:
@@ -85,7 +268,7 @@ def processSystemInstall(pname, cataloglist, runinfo):
     processInstall(pname, cataloglist, False, runinfo)
 
 
-def processInstall(pname, cataloglist, asuser, runinfo):
+def processInstall(pname, cataloglist, asuser, runinfo, since = None):
     """
     Go through all the printers listed and try to add them into
     the system. A printer is only added if the printer type does
@@ -104,11 +287,23 @@ def processInstall(pname, cataloglist, asuser, runinfo):
         mmcommon.log('Printer does not exist in any catalog, ignoring.')
         return
 
-    exists = printers.exists(pname)
+    #
+    # If the catalog entry and the installed PPD are exactly as we
+    # left them after the last install or verification then there
+    # is no need to ask CUPS about the printer at all.
+    #
+    fingerprint = printerFingerprint(data)
+    if printerIsCurrent(pname, fingerprint):
+        mmcommon.log("Printer " + pname + " is already installed and up to date.")
+        metrics.increment('PrintersSkipped')
+        return
+
+    exists = CUPS.exists(pname)
     model = data['Model']
     deviceUri = data['DeviceURI']
     location = data["Location"]
     ppdUrl = data["PPDURL"]
+    ppdChecksum = data.get("PPDChecksum")
     try:
         description = data['Description']
     except:
@@ -120,8 +315,8 @@ def processInstall(pname, cataloglist, asuser, runinfo):
         # against what it should be to determine if we need to
         # re-install.
         #
-        currentInfo = printers.ppdInfo('/etc/cups/ppd/' + pname + '.ppd')
-        currentUri = printers.uri(pname);
+        currentInfo = printers.ppdInfo(installedPPD(pname))
+        currentUri = CUPS.uri(pname)
 
         #
         # Check if we should be up to date based on available information.
@@ -129,35 +324,24 @@ def processInstall(pname, cataloglist, asuser, runinfo):
         if currentUri == deviceUri and printerLastUpdate(pname) == data["LastUpdate"]:
             if currentInfo['ModelName'] == model or currentInfo['NickName'] == model:
                 mmcommon.log("Printer " + pname + " is already installed and up to date.")
+                metrics.increment('PrintersSkipped')
+                printerVerified(pname, fingerprint)
                 return
 
     mmcommon.log("Printer " + pname + " will be installed.")
 
     #
     # Check to make sure the printer is not currently printing.
-    # If there are more than 2 print jobs queued or the system
-    # idle timer is greater than 120 seconds then skip adding
-    # this printer immedietly. Otherwise wait for up to 30
-    # seconds for the jobs to clear. If there are too many
-    # print jobs or the system has been idle, we assume the
-    # print job(s) may take a long time to complete.
+    # Rather than waiting here for the jobs to clear, a busy
+    # printer is deferred and checked again at the end of the
+    # run. If it is still busy then it is saved to the retry
+    # list and picked up by the next retry run.
     #
     if exists:
-        #
-        # Wait for any existing jobs to clear.
-        #
-        if printers.hasJobs(pname):
-            if mmcommon.systemIdleTimer() > 120 or printers.jobCount(pname) > 2:
-                mmcommon.log("Printer " + pname + " is in use and will be updated later.")
-                return
-
-            mmcommon.log("Waiting for printer " + pname + " to become idle.")
-            untilTime = (time.time() + 30)
-            while time.time() < untilTime and printers.jobCount(pname) > 0:
-                time.sleep(5)
-            if time.time() >= untilTime:
-                mmcommon.log("Printer " + pname + " is still in use and will be updated later.")
-                return
+        if CUPS.hasJobs(pname):
+            mmcommon.log("Printer " + pname + " is in use and will be updated later.")
+            deferPrinter(pname, cataloglist, asuser, since)
+            return
 
         #
         # Try to reject jobs before we modify the printer, if
@@ -165,23 +349,35 @@ def processInstall(pname, cataloglist, asuser, runinfo):
         # and we will try again later.
         #
         printers.rejectJobs(pname)
-        if printers.hasJobs(pname):
+        CUPS.invalidate()
+        if CUPS.hasJobs(pname):
             mmcommon.log("Failed to pause printer " + pname + ". Printer will be updated later.")
             printers.acceptJobs(pname)
+            CUPS.invalidate()
+            deferPrinter(pname, cataloglist, asuser, since)
             return
 
     #
     # Okay, add the printer.
     #
+    tempPpd = None
     try:
         #
         # Try to download the new PPD.
         #
         if ppdUrl[:4] == 'drv:':
             ppdfile = ppdUrl
+        elif ppdUrl[:7] == 'http://' or ppdUrl[:8] == 'https://':
+            #
+            # Remote PPDs are kept in the PPD cache so we only
+            # download them again when they change on the server.
+            #
+            mmcommon.log("Downloading PPD from " + ppdUrl)
+            ppdfile = ppdcache.fetch(ppdUrl, ppdChecksum)
         else:
             mmcommon.log("Downloading PPD from " + ppdUrl)
-            ppdfile = mmcommon.download(ppdUrl)
+            ppdfile = mmcommon.download(ppdUrl, None, ppdChecksum)
+            tempPpd = ppdfile
 
         #
         # Build up any options.
@@ -200,82 +396,136 @@ def processInstall(pname, cataloglist, asuser, runinfo):
             if options != None and printers.setOptions(pname, options) == False:
                 raise RuntimeWarning("Failed to set options for printer.")
             printerLastUpdate(pname, data["LastUpdate"])
+            printerVerified(pname, fingerprint)
             mmcommon.log("Printer " + pname + " has been installed.")
+            metrics.increment('PrintersReinstalled' if exists else 'PrintersInstalled')
             if asuser:
                 addedUserPrinter(pname);
         except:
             raise
         finally:
-            if ppdfile[:1] == '/':
-                os.remove(ppdfile)
+            CUPS.invalidate()
+            if tempPpd is not None:
+                os.remove(tempPpd)
     except Exception, e:
         mmcommon.log("Encountered an error trying to install printer " + pname + ": " + str(e))
     finally:
         if exists:
             printers.acceptJobs(pname)
+            CUPS.invalidate()
 
 
 def printerLastUpdate(printer_name, value = None):
     """
     Get the LastUpdate value for the installed named printer.
     """
-    status = mmcommon.readDictionary(MANAGED_PRINTERS_STATUS_PLIST)
-
     if value is None:
-        if status is None:
+        status = STATUS_STORE.get(printer_name)
+        if status is None or "LastUpdate" not in status:
             return -1
 
-        if printer_name not in status or "LastUpdate" not in status[printer_name]:
-            return -1
-
-        return status[printer_name]["LastUpdate"]
+        return status["LastUpdate"]
     else:
-        if status is None:
-            status = { }
+        with STATUS_STORE.lock:
+            status = STATUS_STORE.load()
+            if printer_name not in status:
+                status[printer_name] = { }
 
-        if printer_name not in status:
-            status[printer_name] = { }
+            status[printer_name]["LastUpdate"] = value
+            STATUS_STORE.markDirty()
 
-        status[printer_name]["LastUpdate"] = value
+        return value
 
-        try:
-            mmcommon.writeDictionary(status, MANAGED_PRINTERS_STATUS_PLIST)
-        except:
-            raise
 
-        return value
+#
+# Catalog fields that define how a printer is set up. A change to any
+# of them means the printer needs to be checked again.
+#
+FINGERPRINT_KEYS = [ 'Model', 'DeviceURI', 'PPDURL', 'PPDChecksum', 'PPDOptions', 'LastUpdate', 'Location', 'Description' ]
 
 
-def userPrinters():
-    dict = mmcommon.readDictionary(MANAGED_PRINTERS_PLIST)
-    if dict is None:
-        return []
-    if "UserPrinters" not in dict:
-        return []
+def printerFingerprint(data):
+    """
+    Get a hash of the catalog entry for a printer.
+    """
+    values = dict([ (key, mmcommon.mutableCopy(data[key])) for key in FINGERPRINT_KEYS if key in data ])
+    text = json.dumps(values, sort_keys = True, default = unicode)
 
-    return dict["UserPrinters"]
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
 
 
-def addedUserPrinter(pname):
-    dict = mmcommon.readDictionary(MANAGED_PRINTERS_PLIST)
-    if dict is None:
-        dict = { }
-    if "UserPrinters" not in dict:
-        dict["UserPrinters"] = [ ]
+def installedPPD(printer_name):
+    return CUPS_PPD_DIR + '/' + printer_name + '.ppd'
 
-    if pname not in dict["UserPrinters"]:
-        dict["UserPrinters"] += [pname]
-        mmcommon.writeDictionary(dict, MANAGED_PRINTERS_PLIST)
 
+def ppdMarker(printer_name):
+    """
+    Get the modification time and size of the PPD that CUPS has for the
+    named printer, which changes whenever the printer is modified or
+    deleted. Returns None if there is no PPD.
+    """
+    try:
+        statinfo = os.stat(installedPPD(printer_name))
+    except OSError:
+        return None
+
+    return [ statinfo.st_mtime, statinfo.st_size ]
+
+
+def printerIsCurrent(printer_name, fingerprint):
+    """
+    Check if the named printer was installed or verified with the same
+    catalog entry, its PPD has not been touched since and the last full
+    verification was recent enough.
+    """
+    status = STATUS_STORE.get(printer_name)
+    if status is None or status.get('Fingerprint') != fingerprint:
+        metrics.increment('PrinterFingerprintMisses')
+        return False
+
+    marker = ppdMarker(printer_name)
+    verified = status.get('Verified', 0)
+    if marker is None or status.get('PPDMarker') != marker or time.time() - verified >= mmcommon.pref('PrinterVerifyInterval'):
+        metrics.increment('PrinterFingerprintMisses')
+        return False
+
+    metrics.increment('PrinterFingerprintHits')
+    return True
 
-def removedUserPrinter(pname):
-    dict = mmcommon.readDictionary(MANAGED_PRINTERS_PLIST)
-    if dict is None:
-        return
-    if "UserPrinters" not in dict:
-        return
 
-    if pname in dict["UserPrinters"]:
-        dict["UserPrinters"] = [p for p in dict["UserPrinters"] if p != pname]
-        mmcommon.writeDictionary(dict, MANAGED_PRINTERS_PLIST)
+def printerVerified(printer_name, fingerprint):
+    """
+    Remember that the named printer has been checked against, or
+    installed from, the catalog entry with the given fingerprint.
+    """
+    with STATUS_STORE.lock:
+        status = STATUS_STORE.load()
+        if printer_name not in status:
+            status[printer_name] = { }
+
+        marker = ppdMarker(printer_name)
+        if marker is None:
+            status[printer_name].pop('Fingerprint', None)
+        else:
+            status[printer_name]['Fingerprint'] = fingerprint
+            status[printer_name]['PPDMarker'] = marker
+            status[printer_name]['Verified'] = int(time.time())
+        STATUS_STORE.markDirty()
+
 
+def userPrinters():
+    return list(USER_STORE.get("UserPrinters", [ ]))
+
+
+def addedUserPrinter(pname):
+    with USER_STORE.lock:
+        userprinters = USER_STORE.get("UserPrinters", [ ])
+        if pname not in userprinters:
+            USER_STORE.set("UserPrinters", userprinters + [pname])
+
+
+def removedUserPrinter(pname):
+    with USER_STORE.lock:
+        userprinters = USER_STORE.get("UserPrinters", [ ])
+        if pname in userprinters:
+            USER_STORE.set("UserPrinters", [p for p in userprinters if p != pname])
@@ -17,12 +17,12 @@
 setup_timemachine.py
 """
 import sys
-import socket
 import time
 import os
 import subprocess
 
 from mmlib import mmcommon
+from mmlib import facts
 
 
 def run():
@@ -42,16 +42,16 @@ def processTM(pref):
     """
     if os.path.isfile('/usr/bin/tmutil') and isConfigured() == False:
         # Get the UUID of the system, required.
-        uuid = getUUID()
+        uuid = facts.get('UUID')
         if uuid is None:
             mmcommon.log('Could not determine system UUID')
             return
 
         # Get the short hostname.
-        cpu_name = socket.gethostname().split('.')[0]
+        cpu_name = facts.get('Hostname').split('.')[0]
 
         # Get the OD computer name of the system, required.
-        od_name = getODName(uuid)
+        od_name = facts.get('ODName')
         if od_name is None:
             od_name = cpu_name
 
@@ -85,26 +85,3 @@ def isConfigured():
 
     return True
 
-
-def getUUID():
-    try:
-        value = subprocess.check_output(["/usr/sbin/ioreg -rd1 -c IOPlatformExpertDevice | awk '/IOPlatformUUID/ { split($0, line, \"\\\"\"); printf(\"%s\\n\", line[4]); }'"], stderr=subprocess.STDOUT, shell=True)
-    except:
-        return None
-
-    return value.rstrip()
-
-
-def getODName(uuid):
-    try:
-        ether = subprocess.check_output(["/sbin/ifconfig en0 | grep ether | awk '{ print $2 }'"], stderr=subprocess.STDOUT, shell=True)
-    except:
-        return None
-
-    ether = ether.rstrip()
-    try:
-        name = subprocess.check_output(["/usr/bin/dscl localhost -search /LDAPv3/ldap.hdcnet.org ENetAddress \"" + ether + "\" | grep '^Computers' | awk '{ print $1 }' | cut -f2 -d/ | sed 's/[^-a-z0-9A-Z]//g'"], stderr=subprocess.STDOUT, shell=True)
-    except:
-        return None
-
-    return name.rstrip()
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Daniel Hazelbaker.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+test_ipp.py
+
+Tests for the IPP printer backend against a small IPP responder that
+runs in the test process.
+"""
+import os
+import sys
+import struct
+import socket
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mmlib import ipp
+from mmlib import printers
+from mmlib import mmcommon
+
+
+PPD = '*PPD-Adobe: "4.3"\r\n*DefaultDuplex: None\r\n*DefaultResolution: 300dpi\r\n'
+
+
+class Responder(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers IPP requests the way cupsd would for a single printer and
+    records every request it receives on the server.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path, None, None))
+        self.reply('text/plain', PPD)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        operation = struct.unpack('>H', body[2:4])[0]
+        (unused, groups) = ipp.decodeResponse(body)
+        data = body[body.find('*PPD-Adobe'):] if '*PPD-Adobe' in body else ''
+        self.server.requests.append((operation, self.path, groups, data))
+        if self.server.drop > 0:
+            self.server.drop -= 1
+            self.close_connection = 1
+            return
+
+        status = self.server.status
+        groups = [ (ipp.OPERATION_ATTRIBUTES_TAG, [ ('attributes-charset', ipp.CHARSET, 'utf-8') ]) ]
+        if operation == ipp.GET_PRINTER_ATTRIBUTES and status == 0:
+            groups.append((ipp.PRINTER_ATTRIBUTES_TAG, [
+                ('printer-name', ipp.NAME, 'Office'),
+                ('device-uri', ipp.URI, 'lpd://office/'),
+                ('printer-state', ipp.ENUM, ipp.PRINTER_STATE_IDLE),
+                ('printer-is-accepting-jobs', ipp.BOOLEAN, True),
+                ('queued-job-count', ipp.INTEGER, 2),
+            ]))
+        self.reply('application/ipp', ipp.encodeRequest(status, 1, groups))
+
+    def reply(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Fallback(object):
+    """
+    Stands in for the subprocess backend and records what it is asked.
+    """
+
+    def __init__(self):
+        self.calls = [ ]
+
+    def __getattr__(self, name):
+        def call(*args):
+            self.calls.append(name)
+            return 'fallback'
+        return call
+
+
+class IPPTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Responder)
+        self.server.requests = [ ]
+        self.server.status = 0
+        self.server.drop = 0
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        connection = ipp.IPPConnection('127.0.0.1', self.server.server_address[1])
+        self.backend = ipp.IPPBackend(connection)
+
+        self.saved = (printers.BACKEND, printers.FALLBACK, mmcommon.log)
+        printers.BACKEND = self.backend
+        printers.FALLBACK = Fallback()
+        mmcommon.log = lambda message: None
+
+    def tearDown(self):
+        (printers.BACKEND, printers.FALLBACK, mmcommon.log) = self.saved
+        self.backend.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testEncodeDecode(self):
+        message = ipp.encodeRequest(ipp.CUPS_ADD_MODIFY_PRINTER, 7, [
+            (ipp.OPERATION_ATTRIBUTES_TAG, [
+                ('attributes-charset', ipp.CHARSET, 'utf-8'),
+                ('requested-attributes', ipp.KEYWORD, [ 'printer-name', 'device-uri' ]),
+            ]),
+            (ipp.PRINTER_ATTRIBUTES_TAG, [
+                ('printer-is-shared', ipp.BOOLEAN, False),
+                ('job-k-limit', ipp.INTEGER, -1),
+                ('printer-info', ipp.TEXT, u'Caf\xe9'),
+            ]),
+        ])
+        (operation, groups) = ipp.decodeResponse(message)
+
+        self.assertEqual(operation, ipp.CUPS_ADD_MODIFY_PRINTER)
+        self.assertEqual(groups[0][1]['requested-attributes'], [ 'printer-name', 'device-uri' ])
+        self.assertEqual(groups[1][1]['printer-is-shared'], [ False ])
+        self.assertEqual(groups[1][1]['job-k-limit'], [ -1 ])
+        self.assertEqual(groups[1][1]['printer-info'], [ 'Caf\xc3\xa9' ])
+
+    def testAdd(self):
+        (fd, path) = tempfile.mkstemp()
+        os.write(fd, PPD)
+        os.close(fd)
+        try:
+            self.assertTrue(printers.add('Office', 'lpd://office/', path, 'Room 1', 'Office Printer'))
+        finally:
+            os.remove(path)
+
+        (operation, resource, groups, data) = self.server.requests[-1]
+        self.assertEqual(operation, ipp.CUPS_ADD_MODIFY_PRINTER)
+        self.assertEqual(resource, '/admin/')
+        self.assertEqual(groups[0][1]['printer-uri'], [ 'ipp://localhost/printers/Office' ])
+        self.assertEqual(groups[1][1]['device-uri'], [ 'lpd://office/' ])
+        self.assertEqual(groups[1][1]['printer-location'], [ 'Room 1' ])
+        self.assertEqual(data, PPD)
+        self.assertEqual(printers.FALLBACK.calls, [ ])
+
+    def testSetOptions(self):
+        options = { 'Duplex': 'DuplexNoTumble', 'printer-is-shared': 'false', 'job-sheets-default': 'none,none' }
+        self.assertTrue(printers.setOptions('Office', options))
+
+        (operation, resource, groups, data) = self.server.requests[-1]
+        self.assertEqual(operation, ipp.CUPS_ADD_MODIFY_PRINTER)
+        self.assertTrue('*DefaultDuplex: DuplexNoTumble\r\n' in data)
+        self.assertTrue('*DefaultResolution: 300dpi\r\n' in data)
+        self.assertEqual(groups[1][1]['printer-is-shared'], [ False ])
+        self.assertEqual(groups[1][1]['job-sheets-default'], [ 'none', 'none' ])
+        self.assertEqual(printers.FALLBACK.calls, [ ])
+
+    def testUnsupportedOptionUsesFallback(self):
+        self.assertEqual(printers.setOptions('Office', { 'some-option': 'x' }), 'fallback')
+
+        self.assertEqual([ r[0] for r in self.server.requests ], [ 'GET' ])
+        self.assertEqual(printers.FALLBACK.calls, [ 'setOptions' ])
+        self.assertTrue(printers.BACKEND is self.backend)
+
+    def testQueries(self):
+        self.assertTrue(printers.exists('Office'))
+        self.assertEqual(printers.uri('Office'), 'lpd://office/')
+        self.assertEqual(printers.status('Office'), 'idle')
+
+    def testNoPrinters(self):
+        self.server.status = ipp.CLIENT_ERROR_NOT_FOUND
+        self.assertEqual(printers.snapshotState(), { })
+        self.assertEqual(printers.FALLBACK.calls, [ ])
+
+    def testFailedChangeIsNotReplayed(self):
+        self.server.status = 0x0400
+        self.assertEqual(printers.delete('Office'), False)
+        self.assertEqual(printers.FALLBACK.calls, [ ])
+
+        self.assertEqual(printers.uri('Office'), 'fallback')
+        self.assertEqual(printers.FALLBACK.calls, [ 'uri' ])
+
+    def testDroppedChangeIsNotResent(self):
+        self.server.drop = 1
+        self.assertEqual(printers.delete('Office'), False)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(printers.FALLBACK.calls, [ ])
+
+    def testDroppedQueryIsResent(self):
+        self.server.drop = 1
+        self.assertEqual(printers.uri('Office'), 'lpd://office/')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(printers.FALLBACK.calls, [ ])
+
+    def testUnreachableUsesFallback(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        printers.BACKEND = ipp.IPPBackend(ipp.IPPConnection('127.0.0.1', port, timeout = 5))
+
+        self.assertEqual(printers.delete('Office'), 'fallback')
+        self.assertTrue(printers.BACKEND is printers.FALLBACK)
+
+
+if __name__ == '__main__':
+    unittest.main()
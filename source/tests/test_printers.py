@@ -0,0 +1,126 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Daniel Hazelbaker.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+test_printers.py
+
+Tests for the CUPS printer index using canned lpstat output.
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mmlib import printers
+
+
+LPSTAT_V = """device for Office: lpd://office.example.com/queue
+device for Lab_Color: ipp://10.0.0.5/ipp/print
+device for Front-Desk: dnssd://Front%20Desk._ipp._tcp.local./
+"""
+
+LPSTAT_A = """Office accepting requests since Mon Jan  6 09:12:01 2014
+Lab_Color not accepting requests since Mon Jan  6 09:12:01 2014 -
+\tRejecting Jobs
+Front-Desk accepting requests since Mon Jan  6 09:12:01 2014
+"""
+
+LPSTAT_P = """printer Office now printing Office-41.  enabled since Mon Jan  6 09:12:01 2014
+printer Lab_Color disabled since Mon Jan  6 09:12:01 2014 -
+\tPaused
+printer Front-Desk is idle.  enabled since Mon Jan  6 09:12:01 2014
+"""
+
+LPSTAT_O = """Office-41               alice           123904   Mon Jan  6 09:20:11 2014
+Office-42               bob               2048   Mon Jan  6 09:21:40 2014
+Lab_Color-7             carol            99120   Mon Jan  6 08:02:13 2014
+"""
+
+
+class ParseLpstatTestCase(unittest.TestCase):
+
+    def testDeviceURIs(self):
+        result = printers.parseLpstat(LPSTAT_V)
+
+        self.assertEqual(sorted(result.keys()), [ 'Front-Desk', 'Lab_Color', 'Office' ])
+        self.assertEqual(result['Office']['uri'], 'lpd://office.example.com/queue')
+        self.assertEqual(result['Front-Desk']['uri'], 'dnssd://Front%20Desk._ipp._tcp.local./')
+
+    def testJobs(self):
+        result = printers.parseLpstat(LPSTAT_V + LPSTAT_O)
+
+        self.assertEqual(result['Office']['jobs'], 2)
+        self.assertEqual(result['Lab_Color']['jobs'], 1)
+        self.assertEqual(result['Front-Desk']['jobs'], 0)
+
+    def testState(self):
+        result = printers.parseLpstat(LPSTAT_V + LPSTAT_A + LPSTAT_P + LPSTAT_O)
+
+        self.assertEqual([ result[p]['status'] for p in [ 'Office', 'Lab_Color', 'Front-Desk' ] ],
+                [ 'printing', 'paused', 'idle' ])
+        self.assertEqual([ result[p]['accepting'] for p in [ 'Office', 'Lab_Color', 'Front-Desk' ] ],
+                [ True, False, True ])
+
+
+class CupsSnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.output = LPSTAT_V + LPSTAT_A + LPSTAT_P + LPSTAT_O
+        self.calls = 0
+
+        def lpstat():
+            self.calls += 1
+            return self.output
+
+        self.snapshot = printers.CupsSnapshot(lpstat)
+
+    def testQueries(self):
+        self.assertTrue(self.snapshot.exists('Office'))
+        self.assertFalse(self.snapshot.exists('Missing'))
+        self.assertEqual(self.snapshot.uri('Lab_Color'), 'ipp://10.0.0.5/ipp/print')
+        self.assertEqual(self.snapshot.uri('Missing'), '')
+        self.assertEqual(self.snapshot.status('Front-Desk'), 'idle')
+        self.assertTrue(self.snapshot.hasJobs('Office'))
+        self.assertFalse(self.snapshot.hasJobs('Front-Desk'))
+        self.assertEqual(self.snapshot.jobCount('Missing'), -1)
+        self.assertFalse(self.snapshot.isAccepting('Lab_Color'))
+        self.assertEqual(self.snapshot.printerNames(), [ 'Front-Desk', 'Lab_Color', 'Office' ])
+
+        self.assertEqual(self.calls, 1)
+
+    def testInvalidate(self):
+        self.assertTrue(self.snapshot.exists('Office'))
+
+        self.output = LPSTAT_V.replace('Office', 'Annex')
+        self.assertTrue(self.snapshot.exists('Office'))
+        self.assertEqual(self.calls, 1)
+
+        self.snapshot.invalidate()
+        self.assertFalse(self.snapshot.exists('Office'))
+        self.assertTrue(self.snapshot.exists('Annex'))
+        self.assertEqual(self.calls, 2)
+
+    def testAge(self):
+        self.assertEqual(self.snapshot.age(), None)
+        self.snapshot.exists('Office')
+        self.assertTrue(0 <= self.snapshot.age() < 5)
+
+        self.snapshot.invalidate()
+        self.assertEqual(self.snapshot.age(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()